@@ -0,0 +1,25 @@
+import os,glob,time,numpy
+from colonyzer2 import *
+
+# Compare batched grid scoring (checkPosBatch) with scoring candidate grids one at a time (checkPos), for the same sampling statistic
+DATADIR=os.path.join(os.path.dirname(os.path.realpath(__file__)),"Data","endpoints","384")
+IMAGES=sorted(glob.glob(os.path.join(DATADIR,"*.jpg")))
+
+nx,ny=24,16
+ncand=64
+sampfrac=0.35
+
+print("{:<40} {:>8} {:>10} {:>10} {:>14}".format("Image","stat","loop (s)","batch (s)","max abs. diff."))
+for fname in IMAGES:
+    im,arr=openImage(fname)
+    rng=numpy.random.RandomState(0)
+    d=min(arr.shape[0]/float(ny+1),arr.shape[1]/float(nx+1))
+    params=numpy.column_stack([rng.uniform(0,arr.shape[0]-ny*d,ncand),rng.uniform(0,arr.shape[1]-nx*d,ncand),numpy.full(ncand,d),rng.uniform(-5,5,ncand)])
+    for stat in ["mean","median"]:
+        start=time.time()
+        loop=numpy.array([checkPos(arr,ny,nx,p[0:2],p[2],p[2],p[3],sampfrac=sampfrac,stat=stat) for p in params])
+        tloop=time.time()-start
+        start=time.time()
+        batch=checkPosBatch(arr,ny,nx,params,sampfrac=sampfrac,stat=stat)
+        tbatch=time.time()-start
+        print("{:<40} {:>8} {:>10.3f} {:>10.3f} {:>14.5f}".format(os.path.basename(fname),stat,tloop,tbatch,numpy.max(numpy.abs(loop-batch))))
@@ -0,0 +1,23 @@
+import os,glob,time,numpy
+from colonyzer2 import *
+
+# Compare pyramid approximation (smoothPyramid) with full resolution Gaussian smoothing used for lighting correction maps
+DATADIR=os.path.join(os.path.dirname(os.path.realpath(__file__)),"Data","timecourses")
+IMAGES=sorted(glob.glob(os.path.join(DATADIR,"*.jpg")))
+
+smoothfactor=250
+minsigmas=[2.5,4.0,6.0]
+
+print("{:<40} {:>8} {:>10} {:>10} {:>14} {:>14}".format("Image","minsigma","exact (s)","pyramid (s)","max rel. err.","mean rel. err."))
+for fname in IMAGES:
+    im,arr=openImage(fname)
+    sigma=arr.shape[1]/smoothfactor
+    start=time.time()
+    exact=ndimage.gaussian_filter(arr,sigma)
+    texact=time.time()-start
+    for minsigma in minsigmas:
+        start=time.time()
+        approx=smoothPyramid(arr,sigma,minsigma)
+        tapprox=time.time()-start
+        relerr=numpy.abs(approx/exact-1.0)
+        print("{:<40} {:>8} {:>10.3f} {:>10.3f} {:>14.5f} {:>14.5f}".format(os.path.basename(fname),minsigma,texact,tapprox,numpy.max(relerr),numpy.mean(relerr)))
@@ -1,14 +1,18 @@
-import numpy,pandas,PIL,math,os,sys,time,platform
+import numpy,pandas,PIL,math,os,sys,time,platform,json
 from datetime import datetime
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.patches import Rectangle
 from PIL import Image, ImageDraw, ImageFont
-import scipy
+import scipy, scipy.sparse, scipy.sparse.linalg
 from scipy import stats, optimize, ndimage, signal
 import scipy.optimize as op
 import itertools
 import sobol
+try:
+    from . import maskfill as _maskfill
+except ImportError:
+    _maskfill=None
 
 def is_number(s):
     try:
@@ -149,13 +153,46 @@ def getMaxima(intensity):
             maxima.append(numpy.mean(z)+1)
     return(maxima)
 
-def optimiseSpot(arr,x,y,rad,RAD,mkPlots=False):
+def integralImage(arr):
+    '''Summed-area table for arr, padded with a leading row and column of zeros so that sat[y,x] is the sum of arr[0:y,0:x].'''
+    sat=numpy.zeros((arr.shape[0]+1,arr.shape[1]+1),dtype=numpy.float64)
+    numpy.cumsum(arr,axis=0,dtype=numpy.float64,out=sat[1:,1:])
+    numpy.cumsum(sat[1:,1:],axis=1,out=sat[1:,1:])
+    return(sat)
+
+def boxSums(sat,y0,y1,x0,x1):
+    '''Sums of arr[y0:y1,x0:x1] read from summed-area table sat (corners may be arrays, and are clipped to the image like slices).'''
+    h,w=sat.shape[0]-1,sat.shape[1]-1
+    y0,y1=numpy.clip(y0,0,h),numpy.clip(y1,0,h)
+    x0,x1=numpy.clip(x0,0,w),numpy.clip(x1,0,w)
+    y1,x1=numpy.maximum(y0,y1),numpy.maximum(x0,x1)
+    tot=sat[y1,x1]-sat[y0,x1]-sat[y1,x0]+sat[y0,x0]
+    return((tot,(y1-y0)*(x1-x0)))
+
+def boxMeans(sat,y0,y1,x0,x1):
+    '''Mean of arr[y0:y1,x0:x1] read from summed-area table sat.  Empty boxes give nan, like numpy.mean of an empty slice.'''
+    tot,npix=boxSums(sat,y0,y1,x0,x1)
+    with numpy.errstate(invalid="ignore",divide="ignore"):
+        res=numpy.true_divide(tot,npix)
+    return(numpy.where(npix>0,res,numpy.nan))
+
+def windowProfiles(arr,ymin,ymax,xmin,xmax,rad,sat=None):
+    '''Windowed mean intensity profiles.  sumx[i] is the mean of arr[ymin:ymax,dx-rad:dx+rad] for dx=xmin+i (up to xmax) and sumy[i] the mean of arr[dy-rad:dy+rad,xmin:xmax] for dy=ymin+i.
+Pass a precomputed summed-area table (sat) when scanning many windows in the same image.'''
+    if sat is None:
+        sat=integralImage(arr)
+    dx=numpy.arange(xmin,xmax)
+    dy=numpy.arange(ymin,ymax)
+    sumx=boxMeans(sat,ymin,ymax,numpy.maximum(0,dx-rad),dx+rad)
+    sumy=boxMeans(sat,numpy.maximum(0,dy-rad),dy+rad,xmin,xmax)
+    return((sumx,sumy))
+
+def optimiseSpot(arr,x,y,rad,RAD,mkPlots=False,sat=None):
     '''Search from x-RAD to x+RAD for pixel range dx-rad to dx+rad with the greatest mean intensity (coordinates are top-left corners of cultures)'''
     xmin,xmax=max(0,x-RAD),min(arr.shape[1],x+RAD)
     ymin,ymax=max(0,y-RAD),min(arr.shape[0],y+RAD)
     # Generate windowed mean intensities, scanning along x and y axes
-    sumx=numpy.array([numpy.mean(arr[ymin:ymax,numpy.max([0,dx-rad]):numpy.min([arr.shape[1],dx+rad])]) for dx in range(xmin,xmax)],dtype=numpy.float)
-    sumy=numpy.array([numpy.mean(arr[numpy.max([0,dy-rad]):numpy.min([arr.shape[0],dy+rad]),xmin:xmax]) for dy in range(ymin,ymax)],dtype=numpy.float)
+    sumx,sumy=windowProfiles(arr,ymin,ymax,xmin,xmax,rad,sat)
     # Find all maxima
     maxx=1+numpy.where(numpy.diff(numpy.sign(numpy.diff(sumx)))==-2)[0]
     maxy=1+numpy.where(numpy.diff(numpy.sign(numpy.diff(sumy)))==-2)[0]
@@ -197,7 +234,28 @@ def optimiseSpot(arr,x,y,rad,RAD,mkPlots=False):
         plt.show()
     return(bestx,besty)
 
-def optimiseSpotCANDIDATE(arr,x,y,rad,RAD,mkPlots=False):
+def optimiseSpots(arr,x,y,rad,RAD,sat=None):
+    '''optimiseSpot for arrays of starting positions (x,y) at once: same windowed mean intensity profiles (read from summed-area table sat) and the same choice of maximum, giving the same results.'''
+    if sat is None:
+        sat=integralImage(arr)
+    h,w=arr.shape
+    x,y=numpy.asarray(x,dtype=int)[:,numpy.newaxis],numpy.asarray(y,dtype=int)[:,numpy.newaxis]
+    xmin,xmax=numpy.maximum(0,x-RAD),numpy.minimum(w,x+RAD)
+    ymin,ymax=numpy.maximum(0,y-RAD),numpy.minimum(h,y+RAD)
+    # Profiles for every culture, one position per column (nan outside the search range clipped to the image)
+    dx=x-RAD+numpy.arange(2*RAD)
+    dy=y-RAD+numpy.arange(2*RAD)
+    sumx=numpy.where((dx>=xmin)&(dx<xmax),boxMeans(sat,ymin,ymax,numpy.maximum(0,dx-rad),dx+rad),numpy.nan)
+    sumy=numpy.where((dy>=ymin)&(dy<ymax),boxMeans(sat,numpy.maximum(0,dy-rad),dy+rad,xmin,xmax),numpy.nan)
+    def firstMaximum(prof,pos,start):
+        with numpy.errstate(invalid="ignore"):
+            maxima=numpy.diff(numpy.sign(numpy.diff(prof,axis=1)),axis=1)==-2
+        found=maxima.any(axis=1)
+        best=numpy.take_along_axis(pos,1+numpy.argmax(maxima,axis=1)[:,numpy.newaxis],axis=1)[:,0]
+        return(numpy.where(found,best,start[:,0]))
+    return((firstMaximum(sumx,dx,x),firstMaximum(sumy,dy,y)))
+
+def optimiseSpotCANDIDATE(arr,x,y,rad,RAD,mkPlots=False,sat=None):
         '''Search from x-RAD to x+RAD for pixel range dx-rad to dx+rad with the greatest mean intensity (coordinates are top-left corners of cultures)'''
         xmin,xmax=max(0,x-RAD),min(arr.shape[1],x+RAD)
         ymin,ymax=max(0,y-RAD),min(arr.shape[0],y+RAD)
@@ -205,8 +263,12 @@ def optimiseSpotCANDIDATE(arr,x,y,rad,RAD,mkPlots=False):
         #sumx=numpy.array([numpy.mean(arr[ymin:ymax,numpy.max([0,dx-rad]):numpy.min([arr.shape[1],dx+rad])]) for dx in range(xmin,xmax)],dtype=numpy.float)
         #sumy=numpy.array([numpy.mean(arr[numpy.max([0,dy-rad]):numpy.min([arr.shape[0],dy+rad]),xmin:xmax]) for dy in range(ymin,ymax)],dtype=numpy.float)
 
-        sumx=numpy.array([numpy.mean(arr[y:max(arr.shape[0],y+2*rad),xtarg:max(arr.shape[1],xtarg+2*rad)]) for xtarg in range(xmin,xmax)],dtype=numpy.float)
-        sumy=numpy.array([numpy.mean(arr[ytarg:max(arr.shape[0],ytarg+2*rad),x:max(arr.shape[1],x+2*rad)]) for ytarg in range(ymin,ymax)],dtype=numpy.float)
+        if sat is None:
+            sat=integralImage(arr)
+        xtarg=numpy.arange(xmin,xmax)
+        ytarg=numpy.arange(ymin,ymax)
+        sumx=boxMeans(sat,y,max(arr.shape[0],y+2*rad),xtarg,numpy.maximum(arr.shape[1],xtarg+2*rad))
+        sumy=boxMeans(sat,ytarg,numpy.maximum(arr.shape[0],ytarg+2*rad),x,max(arr.shape[1],x+2*rad))
 
         bestx=xmin+numpy.argmax(sumx)
         besty=ymin+numpy.argmax(sumy)
@@ -236,7 +298,7 @@ def autocor(x):
     '''R-like autocorrelation function'''
     s = numpy.fft.fft(x)
     res=numpy.real(numpy.fft.ifft(s*numpy.conjugate(s)))/numpy.var(x)
-    res=res[0:len(res)/2]
+    res=res[0:len(res)//2]
     return(res)
 
 def showIm(arr,returnIm=False):
@@ -250,7 +312,7 @@ def showIm(arr,returnIm=False):
     else:
         imnew.show()
 
-def sampleArr(arr,pos,svals):
+def sampleArr(arr,pos,svals,stat="median"):
     '''Sum pixel intensities from arr in a rectangle centred on y,x'''
     y,x=pos
     sx,sy=svals
@@ -261,7 +323,10 @@ def sampleArr(arr,pos,svals):
 ##    lsamp=len(samp)
 ##    if lsamp<sx*sy:
 ##        samp=numpy.append(samp,numpy.zeros(sx*sy-lsamp))
-    val=numpy.nanmedian(samp)
+    if stat=="mean":
+        val=numpy.nanmean(samp) if samp.size>0 else numpy.nan
+    else:
+        val=numpy.nanmedian(samp)
     if numpy.isnan(val):
         val=0
     return(val)
@@ -280,22 +345,71 @@ def makeGrid(pos0,ny,nx,dy,dx,theta=0):
     posf=[(int(round(p[0]+pos[0][0])),int(round(p[1]+pos[0][1]))) for p in posr]
     return(posf)
     
-def checkPos(arr,ny,nx,pos0,dy,dx,theta=0,sampfrac=0.1):
+def makeGrids(params,ny,nx):
+    '''Vectorised makeGrid for an (N,4) array of grid parameters (y0,x0,d,theta), with equal row and column gaps d.  Returns (N,ny*nx) integer arrays of y and x coordinates, in makeGrid order.'''
+    params=numpy.atleast_2d(numpy.asarray(params,dtype=numpy.float64))
+    y0,x0,d,theta=[params[:,i:(i+1)] for i in range(0,4)]
+    gy,gx=numpy.meshgrid(numpy.arange(ny),numpy.arange(nx),indexing="ij")
+    gy,gx=gy.ravel()[numpy.newaxis,:],gx.ravel()[numpy.newaxis,:]
+    rads=2*math.pi*theta/360.0
+    s=numpy.sin(-rads)
+    c=numpy.cos(-rads)
+    py=(y0+gy*d)-y0
+    px=(x0+gx*d)-x0
+    posy=numpy.round(px*s+py*c+y0).astype(int)
+    posx=numpy.round(px*c-py*s+x0).astype(int)
+    return((posy,posx))
+
+def windowView(arr,h,w):
+    '''Read-only strided view of all h by w windows of 2D array arr: view[y,x] is arr[y:y+h,x:x+w] (no copy).  Any further axes of arr (e.g. colour channels) are kept after the window axes.'''
+    shape=(arr.shape[0]-h+1,arr.shape[1]-w+1,h,w)+arr.shape[2:]
+    strides=arr.strides[0:2]+arr.strides
+    return(numpy.lib.stride_tricks.as_strided(arr,shape=shape,strides=strides,writeable=False))
+
+def samplePosBatch(arr,ny,nx,params,sampfrac=0.1,stat="median"):
+    '''Vectorised sampleArr at every grid point of an (N,4) array of candidate grids (y0,x0,d,theta), returning an (N,ny*nx) array of sampled intensities.
+Only the mean is vectorised: every rectangle is read from summed-area tables.  Medians (stat="median") are sampled spot by spot with sampleArr, as in checkPos, since gathering and partitioning rectangles for many candidates at once is no faster.'''
+    params=numpy.atleast_2d(numpy.asarray(params,dtype=numpy.float64))
+    h,w=arr.shape
+    posy,posx=makeGrids(params,ny,nx)
+    sxs=numpy.array([int(round(d*sampfrac)) for d in params[:,2]])
+    if stat!="mean":
+        return(numpy.array([[sampleArr(arr,(y,x),(sx,sx),stat) for y,x in zip(py,px)] for py,px,sx in zip(posy,posx,sxs)],dtype=numpy.float64))
+    finite=numpy.isfinite(arr)
+    sat=integralImage(numpy.where(finite,arr,0))
+    cnt=integralImage(finite)
+    y0,y1=numpy.maximum(0,posy-sxs[:,None]),numpy.minimum(h-1,posy+sxs[:,None])
+    x0,x1=numpy.maximum(0,posx-sxs[:,None]),numpy.minimum(w-1,posx+sxs[:,None])
+    # Negative upper corners count from the far edge, as they do when sampleArr slices arr
+    y1,x1=numpy.where(y1<0,y1+h,y1),numpy.where(x1<0,x1+w,x1)
+    tot,npix=boxSums(sat,y0,y1,x0,x1)
+    nfin,npix=boxSums(cnt,y0,y1,x0,x1)
+    with numpy.errstate(invalid="ignore",divide="ignore"):
+        vals=tot/nfin
+    return(numpy.where(nfin>0,vals,0))
+
+def checkPosBatch(arr,ny,nx,params,sampfrac=0.1,stat="median"):
+    '''checkPos for an (N,4) array of candidate grids (y0,x0,d,theta) at once, returning N sums of sampled pixel intensities (vectorised for stat="mean" only, see samplePosBatch).'''
+    return(numpy.sum(samplePosBatch(arr,ny,nx,params,sampfrac,stat),axis=1))
+
+def checkPos(arr,ny,nx,pos0,dy,dx,theta=0,sampfrac=0.1,stat="median"):
     '''Return sum of pixel intensities in arr around grid points'''
     sx=int(round(dx*sampfrac))
     sy=int(round(dy*sampfrac))
     pos=makeGrid(pos0,ny,nx,dy,dx,theta)
-    vals=[sampleArr(arr,p,(sx,sy)) for p in pos]
+    vals=[sampleArr(arr,p,(sx,sy),stat) for p in pos]
     return(sum(vals))
 
-def estimateLocations(arr,nx,ny,windowFrac=0.25,smoothWindow=0.13,showPlt=True,pdf=None,acmedian=True,rattol=0.1,glob=False,verbose=False,nsol=1024):
-    '''Automatically search for best estimate for location of culture array (based on culture centres, not top-left corner).'''
+def estimateLocations(arr,nx,ny,windowFrac=0.25,smoothWindow=0.13,showPlt=True,pdf=None,acmedian=True,rattol=0.1,glob=False,verbose=False,nsol=1024,stat="median",method="sobol",minconf=0.5,returnSoln=False,coarseStat="mean"):
+    '''Automatically search for best estimate for location of culture array (based on culture centres, not top-left corner).
+The coarse pass over nsol Sobol points scores candidate grids with coarseStat (by default the mean, read from summed-area tables), gradient-based refinement uses stat.
+method="fft" reads the grid directly off the power spectrum of arr (see latticeFFT), falling back to the Sobol and gradient-based search if its confidence is below minconf.
+With returnSoln, the grid solution [y0,x0,d,theta] is appended to the returned tuple (e.g. for caching, see warmStartLocations).'''
     # Generate windowed mean intensities, scanning along x and y axes
     # Estimate spot diameter, assuming grid takes up most of the plate
     diam=min(float(arr.shape[0])/ny,float(arr.shape[1])/nx)
     window=int(round(diam*windowFrac))
-    sumx=numpy.array([numpy.mean(arr[0:arr.shape[0],numpy.max([0,dx-window]):numpy.min([arr.shape[1],dx+window])]) for dx in range(0,arr.shape[1])],dtype=numpy.float)
-    sumy=numpy.array([numpy.mean(arr[numpy.max([0,dy-window]):numpy.min([arr.shape[0],dy+window]),0:arr.shape[1]]) for dy in range(0,arr.shape[0])],dtype=numpy.float)
+    sumx,sumy=windowProfiles(arr,0,arr.shape[0],0,arr.shape[1],window)
     # Smooth intensities to help eliminate small local maxima
     sumx=ndimage.gaussian_filter1d(sumx,2.5)
     sumy=ndimage.gaussian_filter1d(sumy,2.5)
@@ -303,6 +417,28 @@ def estimateLocations(arr,nx,ny,windowFrac=0.25,smoothWindow=0.13,showPlt=True,p
     # Look at autocorrelation for first estimate of distance between spots
     maximay=numpy.where(numpy.diff(numpy.sign(numpy.diff(autocor(sumy))))==-2)[0]
     maximax=numpy.where(numpy.diff(numpy.sign(numpy.diff(autocor(sumx))))==-2)[0]
+
+    # Assume we can see the edges of the plate in the image (bright enough to make a peak in the smoothed intensities
+    peaksy=numpy.where(numpy.diff(numpy.sign(numpy.diff(sumy)))==-2)[0]
+    peaksx=numpy.where(numpy.diff(numpy.sign(numpy.diff(sumx)))==-2)[0]
+    corner=[peaksy[0],peaksx[0]]
+
+    com=ndimage.measurements.center_of_mass(arr)
+    com=[int(round(x)) for x in com]
+
+    if method=="fft":
+        soln,conf=latticeFFT(arr,nx,ny)
+        if verbose: print("Lattice detected from power spectrum with confidence {0:.3f}".format(conf))
+        if conf>=minconf:
+            candy,candx=grid(soln,ny,nx)
+            dx=dy=int(round(soln[2]))
+            if showPlt:
+                plotAC(sumy,sumx,candy,candx,maximay,maximax,pdf)
+            if returnSoln:
+                return((candx,candy,dx,dy,corner,com,soln[0:2],soln))
+            return((candx,candy,dx,dy,corner,com,soln[0:2]))
+        if verbose: print("Low confidence in lattice from power spectrum, searching for grid location instead")
+
     if acmedian:
         # Note that median inter-peak distance is more robust here
         # Mean is thrown by outliers: gives poor initial guess for optimisation routine
@@ -325,20 +461,12 @@ def estimateLocations(arr,nx,ny,windowFrac=0.25,smoothWindow=0.13,showPlt=True,p
     checkvecs=[range(ry),range(rx)]
     checkpos=list(itertools.product(*checkvecs))
 
-    # Assume we can see the edges of the plate in the image (bright enough to make a peak in the smoothed intensities
-    peaksy=numpy.where(numpy.diff(numpy.sign(numpy.diff(sumy)))==-2)[0]
-    peaksx=numpy.where(numpy.diff(numpy.sign(numpy.diff(sumx)))==-2)[0]
-    corner=[peaksy[0],peaksx[0]]
-
-    com=ndimage.measurements.center_of_mass(arr)
-    com=[int(round(x)) for x in com]
-
     bounds=[(0,ry),(0,rx),(0.8*min(dy,dx),1.2*max(dy,dx)),(-5,5)]
 
     def makeOptAll(arr,ny,nx,bounds,sampfrac=0.35):
         def optfun(xvs):
             xrs=[b[0]+xv*(b[1]-b[0]) for b,xv in zip(bounds,xvs)]
-            res=-1*checkPos(arr,ny,nx,xrs[0:2],xrs[2],xrs[2],xrs[3],sampfrac=sampfrac)
+            res=-1*checkPos(arr,ny,nx,xrs[0:2],xrs[2],xrs[2],xrs[3],sampfrac=sampfrac,stat=stat)
             return (res)
         return optfun
 
@@ -347,8 +475,15 @@ def estimateLocations(arr,nx,ny,windowFrac=0.25,smoothWindow=0.13,showPlt=True,p
         theta=bounds[3][0]+theta_norm*(bounds[3][1]-bounds[3][0])
         def optfun(xvs):
             xrs=[b[0]+xv*(b[1]-b[0]) for b,xv in zip(bounds[0:2],xvs)]
-            res=-1*checkPos(arr,ny,nx,xrs,dx,dx,theta,sampfrac=sampfrac)
+            res=-1*checkPos(arr,ny,nx,xrs,dx,dx,theta,sampfrac=sampfrac,stat=stat)
             return (res)
+        # Score many normalised positions at once (same objective, vectorised over candidates)
+        def optbatch(xvs,stat=stat):
+            xvs=numpy.asarray(xvs,dtype=numpy.float64)
+            xrs=[b[0]+xvs[:,i]*(b[1]-b[0]) for i,b in enumerate(bounds[0:2])]
+            params=numpy.column_stack(xrs+[numpy.full(len(xvs),dx),numpy.full(len(xvs),theta)])
+            return(-1*checkPosBatch(arr,ny,nx,params,sampfrac=sampfrac,stat=stat))
+        optfun.batch=optbatch
         return optfun
 
     optmess=False
@@ -358,7 +493,7 @@ def estimateLocations(arr,nx,ny,windowFrac=0.25,smoothWindow=0.13,showPlt=True,p
 
     # For even sampling: nsol = Nsamps**Ndim   
     x0s=[sobol.i4_sobol(2,i)[0] for i in range(nsol)]
-    firstpass=[optpos(x) for x in x0s]
+    firstpass=optpos.batch(x0s,stat=coarseStat)
     firstguess=x0s[numpy.argmin(firstpass)]
 
     solpos=op.minimize(optpos,x0=firstguess,method="L-BFGS-B",bounds=[(0.0,1.0) for b in bounds[0:2]],jac=False,options={'eps':0.005,'disp':optmess,'gtol':0.1})
@@ -395,6 +530,8 @@ def estimateLocations(arr,nx,ny,windowFrac=0.25,smoothWindow=0.13,showPlt=True,p
         plotAC(sumy,sumx,candy,candx,maximay,maximax,pdf)
 
     init=[b[0]+xv*(b[1]-b[0]) for b,xv in zip(bounds,xguess)]
+    if returnSoln:
+        return((candx,candy,dx,dy,corner,com,init[0:2],soln))
     return((candx,candy,dx,dy,corner,com,init[0:2]))
 
 def grid(soln,ny,nx):
@@ -405,6 +542,146 @@ def grid(soln,ny,nx):
     candy,candx=list(zip(*grid))
     return((candy,candx))
 
+def downsample(arr,f):
+    '''Block-mean downsampling of 2D array arr by integer factor f (edges padded by replication to a multiple of f).  Pixel i of the result is centred on pixel i*f+(f-1)/2.0 of arr.'''
+    if f<=1:
+        return(numpy.array(arr,dtype=numpy.float64))
+    h,w=arr.shape
+    H,W=int(math.ceil(float(h)/f)),int(math.ceil(float(w)/f))
+    padded=numpy.pad(arr,((0,H*f-h),(0,W*f-w)),mode="edge")
+    return(padded.reshape(H,f,W,f).mean(axis=(1,3),dtype=numpy.float64))
+
+def fourierCoefficient(arr,fy,fx):
+    '''Discrete Fourier coefficient of 2D array arr at an arbitrary (non-integer) frequency, in cycles per pixel along y and x.'''
+    ey=numpy.exp(-2j*math.pi*fy*numpy.arange(arr.shape[0]))
+    ex=numpy.exp(-2j*math.pi*fx*numpy.arange(arr.shape[1]))
+    return(ey.dot(arr).dot(ex))
+
+def latticeFFT(arr,nx,ny,pitchRange=(0.4,1.1),sector=15.0):
+    '''Read gridded array pitch, rotation and phase directly off the 2D power spectrum of arr.
+Returns grid solution [y0,x0,d,theta] (as used by grid()) and a confidence score between 0 and 1.
+Spot pitch is searched for between pitchRange times the largest pitch that fits the image, within sector degrees of the image axes.'''
+    h,w=arr.shape
+    diam=min(float(h)/ny,float(w)/nx)
+    # Downsample so that a spot is roughly 16 pixels across: the number of spectral bins per lattice peak is unchanged
+    f=max(1,int(diam//16))
+    small=downsample(arr,f)
+    small-=numpy.mean(small)
+    sh,sw=small.shape
+    # Taper image edges to stop them leaking power across the spectrum
+    tapered=small*numpy.outer(numpy.hanning(sh),numpy.hanning(sw))
+    power=numpy.abs(numpy.fft.rfft2(tapered))**2
+    fy,fx=numpy.meshgrid(numpy.fft.fftfreq(sh),numpy.fft.rfftfreq(sw),indexing="ij")
+    fmag=numpy.hypot(fx,fy)
+    ang=numpy.degrees(numpy.arctan2(fy,fx))
+    band=(fmag>=f/(pitchRange[1]*diam))&(fmag<=f/(pitchRange[0]*diam))
+    fundamentals,confs=[],[]
+    for insector in (numpy.abs(ang)<=sector,numpy.abs(ang)>=90.0-sector):
+        region=band&insector
+        if not numpy.any(region):
+            return(([0,0,diam,0],0.0))
+        pk=numpy.unravel_index(numpy.argmax(numpy.where(region,power,-1)),power.shape)
+        # Fraction of the power in the search region which lies in the peak
+        rows=[(pk[0]+i)%sh for i in (-1,0,1)]
+        cols=[max(0,min(power.shape[1]-1,pk[1]+j)) for j in (-1,0,1)]
+        confs.append(min(1.0,numpy.sum(power[numpy.ix_(rows,cols)])/numpy.sum(power[region])))
+        # Sub-pixel refinement: maximise the magnitude of the continuous Fourier transform around the peak
+        f0=numpy.array([fy[pk],fx[pk]])
+        res=optimize.minimize(lambda fv:-abs(fourierCoefficient(tapered,fv[0],fv[1])),f0,method="Nelder-Mead",options={"xatol":1e-6,"fatol":1e-9,"initial_simplex":[f0,f0+[0.5/sh,0],f0+[0,0.5/sw]]})
+        fundamentals.append(res.x)
+    (fy1,fx1),(fy2,fx2)=fundamentals
+    d1,d2=1.0/math.hypot(fy1,fx1),1.0/math.hypot(fy2,fx2)
+    phi1=math.atan2(fy1,fx1)
+    phi2=math.atan2(-fx2,fy2)
+    if phi2>math.pi/2.0: phi2-=math.pi
+    if phi2<-math.pi/2.0: phi2+=math.pi
+    # Spot centres lie where both fundamentals are in phase
+    B=numpy.array([[fx1,fy1],[fx2,fy2]])
+    psi=numpy.array([-numpy.angle(fourierCoefficient(tapered,fy1,fx1)),-numpy.angle(fourierCoefficient(tapered,fy2,fx2))])/(2*math.pi)
+    A=numpy.linalg.inv(B)
+    r0=A.dot(psi)
+    a1,a2=A[:,0],A[:,1]
+    # Back to full resolution coordinates (x,y)
+    r0=r0*f+(f-1)/2.0
+    a1,a2=a1*f,a2*f
+    d=f*(d1+d2)/2.0
+    theta=-math.degrees((phi1+phi2)/2.0)
+    # Choose lattice origin (top left culture) so that the whole array lies inside the image and covers the strongest lattice signal.
+    # Demodulating at each fundamental gives the local amplitude of the periodic pattern along rows and along columns.  Plate walls
+    # and image edges are periodic in at most one direction, so the smaller of the two amplitudes is large only where there are cultures.
+    # Capping it at the level reached over the expected area of the array stops any remaining bright patches from dominating.
+    yy,xx=numpy.mgrid[0:sh,0:sw]
+    env=None
+    for (fyv,fxv) in fundamentals:
+        demod=small*numpy.exp(-2j*math.pi*(fyv*yy+fxv*xx))
+        amp=numpy.hypot(ndimage.gaussian_filter(demod.real,(d1+d2)/4.0),ndimage.gaussian_filter(demod.imag,(d1+d2)/4.0))
+        env=amp if env is None else numpy.minimum(env,amp)
+    arrayfrac=min(1.0,nx*ny*(d1*d2)/float(sh*sw))
+    env=numpy.minimum(env,numpy.percentile(env,100.0*(1.0-0.5*arrayfrac)))
+    M=int(math.ceil(max(h,w)/d))+1
+    ms,ns=numpy.meshgrid(numpy.arange(-M,M+1),numpy.arange(-M,M+1),indexing="ij")
+    ms,ns=ms.ravel(),ns.ravel()
+    x0=r0[0]+ms*a1[0]+ns*a2[0]
+    y0=r0[1]+ms*a1[1]+ns*a2[1]
+    params=numpy.column_stack([y0,x0,numpy.full(len(x0),d),numpy.full(len(x0),theta)])
+    posy,posx=makeGrids(params,ny,nx)
+    fits=numpy.all((posy>=0)&(posy<h)&(posx>=0)&(posx<w),axis=1)
+    if not numpy.any(fits):
+        return(([0,0,d,theta],0.0))
+    params,posy,posx=params[fits],posy[fits],posx[fits]
+    scores=numpy.sum(env[numpy.clip(posy//f,0,sh-1),numpy.clip(posx//f,0,sw-1)],axis=1)
+    soln=list(params[numpy.argmax(scores)])
+    conf=min(confs)*min(d1,d2)/max(d1,d2)*math.cos(phi1-phi2)
+    return((soln,max(0.0,conf)))
+
+def gridCacheKey(shape,nrow,ncol,imageDate,bucketDays=7):
+    '''Key for cached grid solutions: image dimensions, plate format and capture date (datetime, see getDate), rounded down to a bucket of bucketDays days.'''
+    bucket=datetime.fromordinal(max(1,bucketDays*(imageDate.toordinal()//bucketDays)))
+    return("{0}x{1}_{2}x{3}_{4}".format(shape[0],shape[1],nrow,ncol,bucket.strftime("%Y-%m-%d")))
+
+def readGridCache(fname):
+    '''Read cached grid solutions (JSON file written by writeGridCache), returning an empty cache if there is none yet.'''
+    if fname is None or not os.path.isfile(fname):
+        return({})
+    with open(fname,"r") as fp:
+        return(json.load(fp))
+
+def writeGridCache(fname,cache):
+    '''Write cached grid solutions to JSON file fname.'''
+    tmpname=fname+".tmp"
+    with open(tmpname,"w") as fp:
+        json.dump(cache,fp,indent=1,sort_keys=True)
+    os.replace(tmpname,fname)
+
+def gridContrast(arr,ny,nx,soln,sampfrac=0.35):
+    '''Relative difference between checkPos score for grid solution soln [y0,x0,d,theta] and for the same grid shifted by half a pitch (agar between cultures).  Close to zero when the grid misses the cultures.'''
+    on=checkPos(arr,ny,nx,soln[0:2],soln[2],soln[2],soln[3],sampfrac=sampfrac)
+    off=checkPos(arr,ny,nx,[soln[0]+soln[2]/2.0,soln[1]+soln[2]/2.0],soln[2],soln[2],soln[3],sampfrac=sampfrac)
+    return((on-off)/max(abs(on),1e-9))
+
+def cacheEntry(arr,ny,nx,located):
+    '''Cache entry for grid solution located (estimateLocations output, with returnSoln=True).'''
+    (candx,candy,dx,dy,corner,com,init,soln)=located
+    return({"soln":[float(x) for x in soln],"dx":int(dx),"dy":int(dy),"contrast":float(gridContrast(arr,ny,nx,soln))})
+
+def warmStartLocations(arr,nx,ny,entry,search=0.1,tol=0.5,verbose=False):
+    '''Start from a cached grid solution (see cacheEntry), search for the best checkPos score within search*pitch pixels of the cached position and verify it.
+Returns an estimateLocations style tuple (with soln) if the contrast of the refined grid is at least tol times the cached contrast, otherwise None (full search required).'''
+    y0,x0,d,theta=entry["soln"]
+    RAD=int(math.ceil(search*d))
+    offy,offx=numpy.meshgrid(numpy.arange(-RAD,RAD+1),numpy.arange(-RAD,RAD+1),indexing="ij")
+    params=numpy.column_stack([y0+offy.ravel(),x0+offx.ravel(),numpy.full(offy.size,d),numpy.full(offy.size,theta)])
+    scores=checkPosBatch(arr,ny,nx,params,sampfrac=0.35,stat="mean")
+    soln=list(params[numpy.argmax(scores)])
+    contrast=gridContrast(arr,ny,nx,soln)
+    if verbose: print("Cached grid contrast {0:.3f} (calibration {1:.3f})".format(contrast,entry["contrast"]))
+    if contrast<tol*entry["contrast"]:
+        return(None)
+    candy,candx=grid(soln,ny,nx)
+    com=ndimage.measurements.center_of_mass(arr)
+    com=[int(round(x)) for x in com]
+    return((candx,candy,entry["dx"],entry["dy"],[0,0],com,soln[0:2],soln))
+
 def plotAC(sumy,sumx,candy,candx,maximay,maximax,pdf=None):
     fig,ax=plt.subplots(2,2,figsize=(15,15))
     acx=autocor(sumx)
@@ -447,8 +724,9 @@ def plotAC(sumy,sumx,candy,candx,maximay,maximax,pdf=None):
     
     
 
-def initialGuess(intensities,counts):
-    '''Construct non-parametric guesses for distributions of two components and use these to estimate Gaussian parameters'''
+def initialGuessArrays(intensities,counts):
+    '''Construct non-parametric guesses for distributions of two components and use these to estimate Gaussian parameters.
+Binned data (non-empty bins only) are returned as a dictionary of arrays: intensities, counts, P1, P2, frac and freq.'''
     # Get all maxima
     maxima=1+numpy.where(numpy.diff(numpy.sign(numpy.diff(counts)))==-2)[0]
     maxima=maxima[counts[maxima]>0.01*numpy.max(counts)]
@@ -470,60 +748,125 @@ def initialGuess(intensities,counts):
     mu2=max(biggest,nextbig)
     
     # Mirror curve from 0...mu1 to estimate distribution of first component
-    P1=numpy.zeros(len(intensities),dtype=numpy.int)
-    halfpeak=counts[0:mu1]
-    for i in range(0,mu1):
-        P1[i]=halfpeak[i]
-    for i in range(mu1,len(intensities)):
-        P1[i]=halfpeak[min(len(halfpeak)-1,max(0,2*len(halfpeak)-i))]
+    idx=numpy.arange(len(intensities))
+    P1=numpy.array(counts[numpy.where(idx<mu1,idx,numpy.clip(2*mu1-idx,0,mu1-1))],dtype=int)
 
     # Mirror curve for second peak also
-    P2=numpy.zeros(len(intensities),dtype=numpy.int)
-    halfpeak=counts[mu2:]
-    for i in range(0,mu2):
-        P2[i]=halfpeak[min(len(halfpeak)-1,mu2-i)]
-    for i in range(mu2,len(intensities)):
-        P2[i]=halfpeak[i-mu2]
-    
-    bindat=pandas.DataFrame(intensities,columns=["intensities"])
-    bindat["counts"]=counts
-    bindat["P1"]=P1
-    bindat["P2"]=P2
+    P2=numpy.array(counts[mu2+numpy.where(idx<mu2,numpy.minimum(len(counts)-mu2-1,mu2-idx),idx-mu2)],dtype=int)
+
     # Calculate standard deviation of (binned) observations from first and second components
-    sigma1=numpy.sqrt(numpy.sum(P1*(numpy.array(intensities-mu1,dtype=numpy.float)**2)/numpy.sum(P1)))
-    sigma2=numpy.sqrt(numpy.sum(P2*(numpy.array(intensities-mu2,dtype=numpy.float)**2)/numpy.sum(P2)))
+    sigma1=numpy.sqrt(numpy.sum(P1*(numpy.array(intensities-mu1,dtype=numpy.float64)**2)/numpy.sum(P1)))
+    sigma2=numpy.sqrt(numpy.sum(P2*(numpy.array(intensities-mu2,dtype=numpy.float64)**2)/numpy.sum(P2)))
     # Estimate component weighting
     theta=float(numpy.sum(P1))/float(numpy.sum(P1)+numpy.sum(P2))
     # Discard empty bins
-    bindat=bindat[bindat.counts>0]
-    bindat["frac"]=numpy.array(numpy.cumsum(bindat.counts),dtype=numpy.float)/numpy.sum(bindat.counts)
-    bindat["freq"]=numpy.array(bindat.counts,dtype=numpy.float)/numpy.sum(bindat.counts)
-    #plotGuess(bindat)
+    keep=counts>0
+    bindat={"intensities":numpy.asarray(intensities)[keep],"counts":numpy.asarray(counts)[keep],"P1":P1[keep],"P2":P2[keep]}
+    total=numpy.sum(bindat["counts"])
+    bindat["frac"]=numpy.array(numpy.cumsum(bindat["counts"]),dtype=numpy.float64)/total
+    bindat["freq"]=numpy.array(bindat["counts"],dtype=numpy.float64)/total
     return((bindat,[theta,mu1,mu2,sigma1,sigma2]))
 
+def initialGuess(intensities,counts):
+    '''Construct non-parametric guesses for distributions of two components and use these to estimate Gaussian parameters (binned data returned as a data frame, see initialGuessArrays)'''
+    (bindat,params)=initialGuessArrays(intensities,counts)
+    return((pandas.DataFrame(bindat),params))
+
 def totFunc(x,p):
-    '''Probability density function for a 2-component mixed Gaussian model'''
+    '''Probability density function for a 2-component mixed Gaussian model (x can be an array).  Models with component means closer than 2 are penalised with a tiny density.'''
     [theta,mu1,mu2,sigma1,sigma2]=p
-    if mu2-mu1<2:
-        candidate=1e-100
-    else:
-        candidate=theta*stats.norm.pdf(x,mu1,sigma1)+(1.0-theta)*stats.norm.pdf(x,mu2,sigma2)
-    return(candidate)
+    candidate=theta*stats.norm.pdf(x,mu1,sigma1)+(1.0-theta)*stats.norm.pdf(x,mu2,sigma2)
+    return(numpy.where(mu2-mu1<2,1e-100,candidate))
 
 def makeObjective(ints,cnts,PDF):
-    '''Returns a function for (log likelihood)*-1 (suitable for minimisation), given a set of binned observations and a PDF'''
-    ints=numpy.array(ints,dtype=numpy.int)
-    cnts=numpy.array(cnts,dtype=numpy.int)
+    '''Returns a function for (log likelihood)*-1 (suitable for minimisation), given a set of binned observations and a PDF (which must accept an array of intensities)'''
+    ints=numpy.array(ints,dtype=int)
+    cnts=numpy.array(cnts,dtype=int)
     def logL(p):
-        modeldens=numpy.array([PDF(x,p) for x in ints],dtype=numpy.float)
+        modeldens=numpy.asarray(PDF(ints,p),dtype=numpy.float64)
         lik=numpy.sum(cnts*numpy.log(modeldens))
         return(-1*lik)
     return(logL)
 
+def makeObjectiveGrad(ints,cnts):
+    '''Returns a function giving (log likelihood)*-1 for the 2-component mixed Gaussian model (totFunc) and its gradient with respect to [theta,mu1,mu2,sigma1,sigma2], for minimisation without finite differences.'''
+    ints=numpy.array(ints,dtype=numpy.float64)
+    cnts=numpy.array(cnts,dtype=int)
+    def logL(p):
+        [theta,mu1,mu2,sigma1,sigma2]=p
+        if mu2-mu1<2:
+            # Same penalty as totFunc, flat in all parameters
+            return((-1*numpy.sum(cnts)*numpy.log(1e-100),numpy.zeros(5)))
+        z1=(ints-mu1)/sigma1
+        z2=(ints-mu2)/sigma2
+        with numpy.errstate(divide="ignore"):
+            l1=numpy.log(theta)+stats.norm.logpdf(z1)-numpy.log(sigma1)
+            l2=numpy.log(1.0-theta)+stats.norm.logpdf(z2)-numpy.log(sigma2)
+        lmix=numpy.logaddexp(l1,l2)
+        # Weighted responsibilities of each component (between 0 and 1, so they cannot overflow)
+        w1=cnts*numpy.exp(l1-lmix)
+        w2=cnts*numpy.exp(l2-lmix)
+        grad=numpy.array([numpy.sum(w1)/theta-numpy.sum(w2)/(1.0-theta),numpy.sum(w1*z1)/sigma1,numpy.sum(w2*z2)/sigma2,numpy.sum(w1*(z1**2-1.0))/sigma1,numpy.sum(w2*(z2**2-1.0))/sigma2])
+        return((-1*numpy.sum(cnts*lmix),-1*grad))
+    return(logL)
+
+def fitMixtureEM(ints,cnts,p,maxiter=1000,tol=1e-10,minsigma=0.5):
+    '''Maximum likelihood estimates for 2-component mixed Gaussian model parameters [theta,mu1,mu2,sigma1,sigma2] given binned observations (counts cnts at intensities ints), by expectation-maximisation starting from parameters p.'''
+    ints=numpy.asarray(ints,dtype=numpy.float64)
+    cnts=numpy.asarray(cnts,dtype=numpy.float64)
+    [theta,mu1,mu2,sigma1,sigma2]=[float(x) for x in p]
+    total=numpy.sum(cnts)
+    oldL=-numpy.inf
+    for i in range(0,maxiter):
+        # E-step: (log) weighted component densities and responsibility of first component for each bin
+        l1=numpy.log(theta)-numpy.log(sigma1)-0.5*((ints-mu1)/sigma1)**2
+        l2=numpy.log(1.0-theta)-numpy.log(sigma2)-0.5*((ints-mu2)/sigma2)**2
+        lmix=numpy.logaddexp(l1,l2)
+        r1=cnts*numpy.exp(l1-lmix)
+        r2=cnts-r1
+        # M-step: weighted moments
+        n1,n2=numpy.sum(r1),numpy.sum(r2)
+        theta=min(max(n1/total,1e-9),1.0-1e-9)
+        mu1=numpy.sum(r1*ints)/n1
+        mu2=numpy.sum(r2*ints)/n2
+        sigma1=max(minsigma,numpy.sqrt(numpy.sum(r1*(ints-mu1)**2)/n1))
+        sigma2=max(minsigma,numpy.sqrt(numpy.sum(r2*(ints-mu2)**2)/n2))
+        L=numpy.sum(cnts*lmix)
+        if abs(L-oldL)<=tol*abs(L):
+            break
+        oldL=L
+    return(numpy.array([theta,mu1,mu2,sigma1,sigma2]))
+
 def getRoot(p,ints):
-    '''Get the point at which two component Gaussians intersect.  Specifically looking for root with highest probability.'''
+    '''Get the point at which two component Gaussians intersect.  Specifically looking for root with highest probability.
+Intersections are roots of a quadratic (log densities are quadratic in x), solved directly.  Falls back to bracketing roots numerically (getRootBrentq) if there is no real root within the range of ints.'''
+    [theta,mu1,mu2,sigma1,sigma2]=[float(x) for x in p]
+    ints=numpy.array(ints,dtype=int)
+    # theta*N(x,mu1,sigma1)=(1-theta)*N(x,mu2,sigma2) <=> a*x**2+b*x+c=0
+    a=1.0/(2.0*sigma2**2)-1.0/(2.0*sigma1**2)
+    b=mu1/sigma1**2-mu2/sigma2**2
+    c=mu2**2/(2.0*sigma2**2)-mu1**2/(2.0*sigma1**2)+numpy.log(theta/(1.0-theta))+numpy.log(sigma2/sigma1)
+    if abs(a)<=1e-12*max(abs(b),abs(c),1e-300):
+        # Equal variances: single root (or none if means are also equal)
+        roots=numpy.array([-c/b]) if b!=0 else numpy.array([])
+    else:
+        disc=b**2-4.0*a*c
+        if disc<0:
+            roots=numpy.array([])
+        else:
+            # Numerically stable form of quadratic formula
+            q=-0.5*(b+math.copysign(math.sqrt(disc),b))
+            roots=numpy.array([q/a,c/q]) if q!=0 else numpy.array([0.0])
+    roots=roots[(roots>=numpy.min(ints))&(roots<=numpy.max(ints))]
+    if len(roots)==0:
+        return(getRootBrentq(p,ints))
+    p1=stats.norm.pdf(roots,mu1,sigma1)
+    return(roots[numpy.argmax(p1)])
+
+def getRootBrentq(p,ints):
+    '''Get the point at which two component Gaussians intersect, by bracketing sign changes of the difference between weighted densities over ints and refining with brentq.  Specifically looking for root with highest probability.'''
     [theta,mu1,mu2,sigma1,sigma2]=p
-    ints=numpy.array(ints,dtype=numpy.int)
+    ints=numpy.array(ints,dtype=int)
     def diffFunc(x):
         return(theta*stats.norm.pdf(x,mu1,sigma1)-(1.0-theta)*stats.norm.pdf(x,mu2,sigma2))
     # Find pairs of points in truncated, filtered intensity list which bracket any roots
@@ -551,7 +894,8 @@ def thresholdArr(arrim,thresh):
     return(imnew)
 
 def plotGuess(bindat,label="",pdf=None):
-    '''Plot intensity frequency histogram and non-parametric estimates of component distributions'''
+    '''Plot intensity frequency histogram and non-parametric estimates of component distributions (bindat is a data frame or dictionary of arrays)'''
+    bindat=pandas.DataFrame(bindat)
     plt.figure()
     plt.plot(bindat.intensities,bindat.counts,color="black")
     plt.plot(bindat.intensities,bindat.P1,color="red")
@@ -566,7 +910,8 @@ def plotGuess(bindat,label="",pdf=None):
         plt.close()
 
 def plotModel(bindat,thresholds=(),label="",pdf=None):
-    '''Plot intensity density histogram, modelled distribution, component distributions and threshold estimate.'''
+    '''Plot intensity density histogram, modelled distribution, component distributions and threshold estimate (bindat is a data frame or dictionary of arrays).'''
+    bindat=pandas.DataFrame(bindat)
     plt.figure()
     plt.plot(bindat.intensities,bindat.freq,color="black")
     plt.plot(bindat.intensities,bindat.gauss1,color="red")
@@ -583,82 +928,274 @@ def plotModel(bindat,thresholds=(),label="",pdf=None):
         pdf.savefig()
         plt.close()
 
-def getEdges(arr,cutoff=0.9975):
-    '''Sobel edge detection for 2d array using scipy functions'''
-    sx = ndimage.sobel(arr, axis=0)
-    sy = ndimage.sobel(arr, axis=1)
-    sob = numpy.hypot(sx, sy)
-    sob[sob<stats.mstats.mquantiles(sob,cutoff)[0]]=0
-    sob[sob>0]=1
-    return(numpy.array(sob,dtype=numpy.bool))  
-
-def sizeSpots(locations,arr,thresharr,edge,background=0):
-    '''Add intensity measures and other phenotypes to locations dataFrame'''
+def squaredSobelRows(arr,rows):
+    '''Squared Sobel gradient magnitudes (as in getEdges) of arr along interior rows only (1<=row<arr.shape[0]-1), without filtering the rest of arr.'''
+    rows=numpy.asarray(rows,dtype=int)
+    above,centre,below=arr[rows-1],arr[rows],arr[rows+1]
+    sx=ndimage.correlate1d(below-above,[1,2,1],axis=1)
+    sy=ndimage.correlate1d(above+2*centre+below,[-1,0,1],axis=1)
+    return(sx*sx+sy*sy)
+
+def quantileThreshold(vals,cutoff):
+    '''Value of vals at or above which lie the values above quantile cutoff (as interpolated by stats.mstats.mquantiles), from the two order statistics either side of the quantile (numpy.partition) rather than a full sort.'''
+    # Plotting positions as in mquantiles (alphap=betap=0.4)
+    n=vals.size
+    aleph=n*cutoff+0.4+0.2*cutoff
+    k=int(math.floor(min(max(aleph,1),n-1)))
+    gamma=min(max(aleph-k,0.0),1.0)
+    lower,upper=numpy.partition(vals,[k-1,k],axis=None)[[k-1,k]]
+    # Nothing lies between consecutive order statistics, so an interpolated quantile above the lower one selects the same values as the upper one
+    return(lower if gamma==0 else upper)
+
+def getEdges(arr,cutoff=0.9975,bounds=None,out=None,sample=None):
+    '''Sobel edge detection for 2d array using scipy functions
+Edges are pixels with gradient magnitude at or above quantile cutoff (as interpolated by stats.mstats.mquantiles, see quantileThreshold).
+Pixels are ranked by squared magnitude, so the edge map is identical to thresholding numpy.hypot magnitudes at the mquantiles cutoff except for tie-breaking at the cutoff: on quantized images with many tied magnitudes, pixels whose magnitude equals the cutoff (to rounding) can fall on either side.
+Optionally restricted to bounds (y0,y1,x0,x1, see gridBounds), with the quantile taken there too, and written into an existing boolean array out.
+With sample, the quantile is instead estimated over the whole of arr from every sample-th row (see squaredSobelRows), so that edges within bounds are thresholded much as they would be for the whole image without filtering all of it.'''
+    if out is None:
+        out=numpy.zeros(arr.shape,dtype=bool)
+    if bounds is None:
+        bounds=(0,arr.shape[0],0,arr.shape[1])
+    else:
+        out[...]=False
+    y0,y1,x0,x1=bounds
+    # Keep one pixel of real neighbours around bounds for the Sobel filters
+    py0,py1,px0,px1=max(0,y0-1),min(arr.shape[0],y1+1),max(0,x0-1),min(arr.shape[1],x1+1)
+    mag=ndimage.sobel(arr[py0:py1,px0:px1],axis=0)
+    sy=ndimage.sobel(arr[py0:py1,px0:px1],axis=1)
+    # Squared gradient magnitude (same ordering as magnitude), in place
+    numpy.multiply(mag,mag,out=mag)
+    numpy.multiply(sy,sy,out=sy)
+    mag+=sy
+    mag=mag[y0-py0:y1-py0,x0-px0:x1-px0]
+    if sample is None:
+        thresh=quantileThreshold(mag,cutoff)
+    else:
+        thresh=quantileThreshold(squaredSobelRows(arr,numpy.arange(1,arr.shape[0]-1,sample)),cutoff)
+    region=out[y0:y1,x0:x1]
+    if thresh>0:
+        numpy.greater_equal(mag,thresh,out=region)
+    else:
+        numpy.greater(mag,0,out=region)
+    return(out)
+
+def cultureMask(arr,locations,cutoff=0.8,margin=6,sample=8):
+    '''Mask covering cultures (and their edges), for cutting cultures out of an image before filling in gaps (see maskAndFill).
+Sobel edges (see getEdges) are dilated, holes filled and the result eroded only within the area covered by the culture grid (one culture pitch around each culture, see gridBounds) plus margin pixels.  The edge threshold is still a quantile over the whole image, estimated from every sample-th row, since a quantile within the grid would find as many "edges" on an empty plate as on a grown one.'''
+    d=locations.Diameter.iloc[0]
+    y0,y1,x0,x1=gridBounds(locations,d,d,arr.shape)
+    y0,y1,x0,x1=max(0,y0-margin),min(arr.shape[0],y1+margin),max(0,x0-margin),min(arr.shape[1],x1+margin)
+    mask=getEdges(arr,cutoff,bounds=(y0,y1,x0,x1),out=numpy.zeros(arr.shape,dtype=bool),sample=sample)
+    dil=ndimage.binary_dilation(mask[y0:y1,x0:x1],iterations=5)
+    fill=ndimage.binary_fill_holes(dil)
+    mask[y0:y1,x0:x1]=ndimage.binary_erosion(fill,iterations=7)
+    return(mask)
+
+def spotLabels(locations,shape):
+    '''Square tiles (side 2*rad+1, rad half the largest culture diameter) centred on each culture, for measuring every culture in an image (dimensions shape) at once (see sizeSpots).  Compute once for a set of culture locations and reuse for every image in a timecourse.
+Neighbouring tiles overlap by a few pixels, so rather than as a label image, tiles are described by top left corners (ty,tx), kept inside the image, and a mask (valid) of the pixels in each tile that belong to the culture's tile before clipping at image edges.'''
+    rad=int(math.ceil(max(locations.Diameter.values)/2.0))
+    side=2*rad+1
+    # Round half up, so that tiles move with the image when it is cropped (see cropRegion)
+    y0=numpy.floor(locations.y.values+0.5).astype(int)-rad
+    x0=numpy.floor(locations.x.values+0.5).astype(int)-rad
+    ty=numpy.clip(y0,0,shape[0]-side)
+    tx=numpy.clip(x0,0,shape[1]-side)
+    off=numpy.arange(side)
+    validy=numpy.abs(ty[:,numpy.newaxis]+off-(y0[:,numpy.newaxis]+rad))<=rad
+    validx=numpy.abs(tx[:,numpy.newaxis]+off-(x0[:,numpy.newaxis]+rad))<=rad
+    valid=validy[:,:,numpy.newaxis]&validx[:,numpy.newaxis,:]
+    return((ty,tx,valid))
+
+def spotStack(arr,labels):
+    '''Copy tiles around every culture (see spotLabels) from arr into a single array, one tile per culture.'''
+    ty,tx,valid=labels
+    return(windowView(arr,valid.shape[1],valid.shape[2])[ty,tx])
+
+def histogramMedians(vals,masks,lo=0,nbins=256,maxpix=2**20):
+    '''Same as segmentMedians, for integer data in the range lo to lo+nbins-1 (e.g. 8 bit images).
+Builds histograms for every tile and mask by counting (bincount, on blocks of tiles with up to about maxpix pixels) and reads medians off the cumulative counts, without sorting.'''
+    n,nclass=vals.shape[0],len(masks)
+    width=(nclass+1)*nbins
+    # Histogram bin for every pixel within its tile, by mask (pixels under no mask in an extra histogram) and intensity
+    key=numpy.subtract(vals.reshape(n,-1),lo,dtype=numpy.uint16 if width<=2**16 else numpy.intp,casting="unsafe")
+    covered=numpy.zeros(key.shape,dtype=bool)
+    for c in range(nclass):
+        m=masks[c].reshape(n,-1)
+        if c>0:
+            numpy.add(key,key.dtype.type(c*nbins),out=key,where=m)
+        covered|=m
+    numpy.add(key,key.dtype.type(nclass*nbins),out=key,where=numpy.logical_not(covered))
+    counts=numpy.empty((n,width),dtype=numpy.intp)
+    rows=max(1,maxpix//key.shape[1])
+    offsets=(numpy.arange(rows,dtype=numpy.intp)*width)[:,numpy.newaxis]
+    for i in range(0,n,rows):
+        block=key[i:i+rows]
+        counts[i:i+len(block)]=numpy.bincount((block+offsets[0:len(block)]).ravel(),minlength=len(block)*width).reshape(len(block),width)
+    cum=numpy.cumsum(counts.reshape(n,nclass+1,nbins)[:,0:nclass],axis=2)
+    total=cum[:,:,-1]
+    # Value of order statistic k is the first bin whose cumulative count exceeds k
+    first=numpy.sum(cum<=(numpy.maximum(total-1,0)//2)[:,:,numpy.newaxis],axis=2)
+    second=numpy.sum(cum<=(total//2)[:,:,numpy.newaxis],axis=2)
+    meds=0.5*(first+second)+lo
+    meds[total==0]=numpy.nan
+    return(meds)
+
+def segmentMedians(vals,masks):
+    '''Median of the values in each tile (first axis of vals), separately for each of a list of disjoint boolean masks (same shape as vals).
+All medians come from a single sort of each tile, with the pixels under each mask offset from those under the others.  Returns array (tiles,len(masks)), NaN where a mask is empty.'''
+    n,nclass=vals.shape[0],len(masks)
+    masks=[m.reshape(n,-1) for m in masks]
+    lo,hi=numpy.min(vals),numpy.max(vals)
+    if numpy.issubdtype(vals.dtype,numpy.integer) and int(hi)-int(lo)<256:
+        # 8 bit data: counting rather than sorting
+        return(histogramMedians(vals,masks,lo=int(lo),nbins=256))
+    span=2.0**math.ceil(math.log(float(hi)-float(lo)+1.0,2))
+    if numpy.issubdtype(vals.dtype,numpy.integer) and (nclass+1)*span<=2**16:
+        # Integer data (e.g. 8 bit colour channels): exact 16 bit keys, faster to sort
+        key=numpy.subtract(vals.reshape(n,-1),lo,dtype=numpy.uint16,casting="unsafe")
+        ignore=2**16-1
+    else:
+        key=numpy.subtract(vals.reshape(n,-1),lo,dtype=numpy.float64)
+        ignore=numpy.inf
+    for c in range(1,nclass):
+        numpy.add(key,key.dtype.type(c*span),out=key,where=masks[c])
+    numpy.copyto(key,ignore,where=numpy.logical_not(numpy.logical_or.reduce(masks)))
+    key.sort(axis=1)
+    counts=numpy.stack([numpy.count_nonzero(m,axis=1) for m in masks],axis=1)
+    starts=numpy.cumsum(counts,axis=1)-counts
+    rows=numpy.arange(n)[:,numpy.newaxis]
+    first=numpy.minimum(starts+numpy.maximum(counts-1,0)//2,key.shape[1]-1)
+    second=numpy.minimum(starts+counts//2,key.shape[1]-1)
+    meds=0.5*(key[rows,first].astype(numpy.float64)+key[rows,second])-numpy.arange(nclass)*span+lo
+    meds[counts==0]=numpy.nan
+    return(meds)
+
+def greyTiles(get,src):
+    '''Grey level tiles (cultures,pixels) with background intensity subtracted, for spotReductions.'''
+    if numpy.issubdtype(src["arr"].dtype,numpy.integer):
+        return(get("rawTiles")-numpy.float64(src["background"]))
+    tiles=spotStack(src["arr"],src["labels"]).reshape(src["n"],-1)
+    tiles-=src["background"]
+    return(tiles)
+
+def greyMedians(get,src):
+    '''Feature and background median grey levels (cultures,2), background subtracted, for spotReductions.
+Integer (e.g. 8 bit) images are counted (see histogramMedians) before subtracting background.'''
+    masks=[get("feature"),get("back")]
+    if numpy.issubdtype(src["arr"].dtype,numpy.integer):
+        return(segmentMedians(get("rawTiles"),masks)-src["background"])
+    return(segmentMedians(get("tiles"),masks))
+
+def featureVariance(get,src):
+    '''Variance of feature grey levels (scaled to 0-1) for each culture, for spotReductions.'''
     intMax=255.0
-    # http://en.wikipedia.org/wiki/Shape_factor_(image_analysis_and_microscopy)#Circularity
-    # Calculate area, intensity and trimmed intensity for each spot
-    sumInt,sumArea,trim,fMed,bMed,circ,fVar,perim=[],[],[],[],[],[],[],[]
-    for i in range(0,len(locations.x.values)):
-        x,y,rad=locations.x.values[i],locations.y.values[i],int(math.ceil(max(locations.Diameter.values)/2.0))
-        tile=arr[max(0,y-rad):min(arr.shape[0],(y+rad+1)),max(0,x-rad):min(arr.shape[1],(x+rad+1))]-background
-        threshtile=thresharr[max(0,y-rad):min(arr.shape[0],(y+rad+1)),max(0,x-rad):min(arr.shape[1],(x+rad+1))]
-        edgetile=edge[max(0,y-rad):min(arr.shape[0],(y+rad+1)),max(0,x-rad):min(arr.shape[1],(x+rad+1))]
-        perimeter=numpy.sum(edgetile)
-        area=numpy.sum(threshtile)
-        if perimeter>0:
-            circularity=4*math.pi*area/(perimeter)**2
+    dev=(get("tiles")-(get("featureSum")/get("area"))[:,numpy.newaxis])/intMax
+    return(numpy.einsum("ij,ij,ij->i",dev,dev,get("feature"))/get("area"))
+
+def edgeTiles(get,src):
+    '''Sobel edge pixels (see getEdges, computed here at cutoff 0.925 if not supplied) in each tile, for spotReductions.'''
+    edge=src["edge"]
+    if edge is None:
+        edge=getEdges(src["arr"],0.925)
+    return(spotStack(edge,src["labels"]).reshape(src["n"],-1)&get("valid"))
+
+def colourTiles(get,src):
+    '''Tiles from 24 bit image (cultures,channels,pixels), taken from a strided view (cultures,height,width,channels) of the decoded RGB array, for spotReductions.'''
+    im=src["im"]
+    if im.mode!="RGB":
+        im=im.convert("RGB")
+    return(numpy.ascontiguousarray(spotStack(numpy.asarray(im),src["labels"]).reshape(src["n"],-1,3).transpose(0,2,1)))
+
+def colourMedians(get,src):
+    '''Feature and background median of each colour channel (cultures,channels,2), from a single call with one row per culture and channel, for spotReductions.'''
+    n=src["n"]
+    masks=[numpy.repeat(get("feature"),3,axis=0),numpy.repeat(get("back"),3,axis=0)]
+    return(segmentMedians(get("colourTiles").reshape(3*n,-1),masks).reshape(n,3,2))
+
+# Per-culture reductions shared between phenotypes: name -> function(get,src), where get(name) returns any other reduction and src holds
+# the images (arr, im, thresharr, edge), background intensity, tiles (labels, see spotLabels) and number of cultures (n)
+spotReductions={
+    "valid":lambda get,src:src["labels"][2].reshape(src["n"],-1),
+    "threshTiles":lambda get,src:spotStack(src["thresharr"],src["labels"]).reshape(src["n"],-1),
+    "feature":lambda get,src:get("threshTiles")&get("valid"),
+    "back":lambda get,src:numpy.logical_not(get("threshTiles"))&get("valid"),
+    "rawTiles":lambda get,src:spotStack(src["arr"],src["labels"]).reshape(src["n"],-1),
+    "tiles":greyTiles,
+    "size":lambda get,src:numpy.count_nonzero(get("valid"),axis=1).astype(numpy.float64),
+    "area":lambda get,src:numpy.count_nonzero(get("feature"),axis=1).astype(numpy.float64),
+    "backArea":lambda get,src:numpy.count_nonzero(get("back"),axis=1).astype(numpy.float64),
+    "edges":edgeTiles,
+    "perimeter":lambda get,src:numpy.count_nonzero(get("edges"),axis=1).astype(numpy.float64),
+    "tileSum":lambda get,src:numpy.einsum("ij,ij->i",get("tiles"),get("valid")),
+    "featureSum":lambda get,src:numpy.einsum("ij,ij->i",get("tiles"),get("feature")),
+    "featureVariance":featureVariance,
+    "greyMedians":greyMedians,
+    "colourTiles":colourTiles,
+    "colourMeans":lambda get,src:numpy.einsum("icp,ip->ic",get("colourTiles"),get("feature"),dtype=numpy.int64)/get("area")[:,numpy.newaxis],
+    "colourMeansBack":lambda get,src:numpy.einsum("icp,ip->ic",get("colourTiles"),get("back"),dtype=numpy.int64)/get("backArea")[:,numpy.newaxis],
+    "colourMedians":colourMedians,
+}
+
+phenotypes=[]
+
+def registerPhenotype(name,needs,func):
+    '''Add (or replace) phenotype name, measured by measurePhenotypes along with every other phenotype.
+func is called with the reductions named in needs (see spotReductions, which can be extended too), one argument each, and returns one value per culture.  E.g. registerPhenotype("FeatureMax",("tiles","feature"),lambda t,f:numpy.max(numpy.where(f,t,-numpy.inf),axis=1)).'''
+    phenotypes[:]=[p for p in phenotypes if p[0]!=name]+[(name,tuple(needs),func)]
+
+def circularity(area,perimeter):
+    '''Circularity 4*pi*area/perimeter**2 (0 where there are no edges): http://en.wikipedia.org/wiki/Shape_factor_(image_analysis_and_microscopy)#Circularity'''
+    circ=numpy.zeros(len(area))
+    circ[perimeter>0]=4*math.pi*area[perimeter>0]/(perimeter[perimeter>0])**2
+    return(circ)
+
+sizePhenotypes=("Intensity","Area","Trimmed","FeatureMedian","FeatureVariance","BackgroundMedian","Circularity","Perimeter")
+registerPhenotype("Intensity",("tileSum","size"),lambda s,size:s/(size*255.0))
+registerPhenotype("Area",("area","size"),lambda area,size:area/size)
+registerPhenotype("Trimmed",("featureSum","size"),lambda s,size:s/(size*255.0))
+registerPhenotype("FeatureMedian",("greyMedians",),lambda m:m[:,0]/255.0/255.0)
+registerPhenotype("FeatureVariance",("featureVariance",),lambda v:v)
+registerPhenotype("BackgroundMedian",("greyMedians",),lambda m:m[:,1]/255.0/255.0)
+registerPhenotype("Circularity",("area","perimeter"),circularity)
+registerPhenotype("Perimeter",("perimeter","size"),lambda p,size:p/size)
+
+colourPhenotypes=[]
+for stat,reduction,col in (("Mean","colourMeans",None),("MeanBack","colourMeansBack",None),("Median","colourMedians",0),("MedianBack","colourMedians",1)):
+    for c,channel in enumerate(("red","green","blue")):
+        colourPhenotypes.append(channel+stat)
+        if col is None:
+            registerPhenotype(channel+stat,(reduction,),lambda m,c=c:m[:,c])
         else:
-            circularity=0
-        featureMedian=numpy.median(tile[threshtile])/intMax
-        backgroundMedian=numpy.median(tile[numpy.logical_not(threshtile)])/intMax
-        sumInt.append(float(numpy.sum(tile))/(float(tile.size)*intMax))
-        sumArea.append(float(area)/float(tile.size))
-        trim.append(float(numpy.sum(tile[threshtile]))/(float(tile.size)*intMax))
-        fMed.append(featureMedian/intMax)
-        bMed.append(backgroundMedian/intMax)
-        circ.append(circularity)
-        fVar.append(numpy.var(tile[threshtile]/intMax))
-        perim.append(float(perimeter)/float(tile.size))
-    locations["Intensity"]=sumInt
-    locations["Area"]=sumArea
-    locations["Trimmed"]=trim
-    locations["FeatureMedian"]=fMed
-    locations["FeatureVariance"]=fVar
-    locations["BackgroundMedian"]=bMed
-    locations["Circularity"]=circ
-    locations["Perimeter"]=perim
+            registerPhenotype(channel+stat,(reduction,),lambda m,c=c,col=col:m[:,c,col])
+colourPhenotypes=tuple(colourPhenotypes)
+del stat,reduction,col,c,channel
+
+def measurePhenotypes(locations,arr,thresharr,im=None,background=0,labels=None,edge=None,names=None):
+    '''Add phenotypes (all registered, see registerPhenotype, or only those in names) to locations dataFrame, given grey level array arr, 24 bit image im (for colours), culture mask thresharr and background intensity.
+Every culture is measured at once from stacks of tiles (labels, see spotLabels, computed here if not supplied).  Reductions needed by the phenotypes (see spotReductions) are each computed once, on first use, and shared, so that extra phenotypes do not add passes over the image.'''
+    if labels is None:
+        labels=spotLabels(locations,thresharr.shape)
+    src={"arr":arr,"im":im,"thresharr":thresharr,"edge":edge,"background":background,"labels":labels,"n":len(labels[2])}
+    cache={}
+    def get(reduction):
+        if reduction not in cache:
+            cache[reduction]=spotReductions[reduction](get,src)
+        return(cache[reduction])
+    with numpy.errstate(invalid="ignore",divide="ignore"):
+        for name,needs,func in phenotypes:
+            if names is None or name in names:
+                locations[name]=func(*[get(r) for r in needs])
     return(locations)
 
-def getColours(im,locations,thresharr):
-    '''Extract feature and background mean and median Red Green and Blue channel values for a given 24 bit image'''
-    (red,green,blue)=im.split()
-    redarr,greenarr,bluearr=numpy.array(red,dtype=numpy.uint8),numpy.array(green,dtype=numpy.uint8),numpy.array(blue,dtype=numpy.uint8)
-    r,g,b,rB,gB,bB,rm,gm,bm,rmB,gmB,bmB=[],[],[],[],[],[],[],[],[],[],[],[]
-    store=numpy.zeros((len(locations.x.values),12),numpy.float)
-    for i in range(0,len(locations.x.values)):
-        x,y,rad=locations.x.values[i],locations.y.values[i],int(math.ceil(max(locations.Diameter.values)/2.0))
-        redtile=redarr[y-rad:(y+rad+1),x-rad:(x+rad+1)]
-        greentile=greenarr[y-rad:(y+rad+1),x-rad:(x+rad+1)]
-        bluetile=bluearr[y-rad:(y+rad+1),x-rad:(x+rad+1)]
-        threshtile=thresharr[y-rad:(y+rad+1),x-rad:(x+rad+1)]
-        rMean,gMean,bMean=numpy.mean(redtile[threshtile]),numpy.mean(greentile[threshtile]),numpy.mean(bluetile[threshtile])
-        rMed,gMed,bMed=numpy.median(redtile[threshtile]),numpy.median(greentile[threshtile]),numpy.median(bluetile[threshtile])
-        rMeanBk,gMeanBk,bMeanBk=numpy.mean(redtile[numpy.logical_not(threshtile)]),numpy.mean(greentile[numpy.logical_not(threshtile)]),numpy.mean(bluetile[numpy.logical_not(threshtile)])
-        rMedBk,gMedBk,bMedBk=numpy.median(redtile[numpy.logical_not(threshtile)]),numpy.median(greentile[numpy.logical_not(threshtile)]),numpy.median(bluetile[numpy.logical_not(threshtile)])
-        store[i]=[rMean,gMean,bMean,rMeanBk,gMeanBk,bMeanBk,rMed,gMed,bMed,rMedBk,gMedBk,bMedBk]
-    locations["redMean"]=store[:,0]
-    locations["greenMean"]=store[:,1]
-    locations["blueMean"]=store[:,2]
-    locations["redMeanBack"]=store[:,3]
-    locations["greenMeanBack"]=store[:,4]
-    locations["blueMeanBack"]=store[:,5]
-    locations["redMedian"]=store[:,6]
-    locations["greenMedian"]=store[:,7]
-    locations["blueMedian"]=store[:,8]
-    locations["redMedianBack"]=store[:,9]
-    locations["greenMedianBack"]=store[:,10]
-    locations["blueMedianBack"]=store[:,11]
-    return(locations)      
+def sizeSpots(locations,arr,thresharr,edge,background=0,labels=None):
+    '''Add intensity measures and other phenotypes to locations dataFrame (see measurePhenotypes).'''
+    return(measurePhenotypes(locations,arr,thresharr,background=background,labels=labels,edge=edge,names=sizePhenotypes))
+
+def getColours(im,locations,thresharr,labels=None):
+    '''Extract feature and background mean and median Red Green and Blue channel values for a given 24 bit image (see measurePhenotypes).'''
+    return(measurePhenotypes(locations,None,thresharr,im=im,labels=labels,names=colourPhenotypes))
 
 def saveColonyzer(filename,locs,thresh,dx,dy):
     '''Save output data in original Colonyzer format'''
@@ -685,8 +1222,7 @@ def saveColonyzer(filename,locs,thresh,dx,dy):
     df["YDIM"]=dy
     colorder=("FILENAME","ROW","COLUMN","TOPLEFTX","TOPLEFTY","WHITEAREA","TRIMMED","THRESHOLD","INTENSITY","EDGEPIXELS","COLR","COLG","COLB","BKR","BKG","BKB","EDGELEN","XDIM","YDIM")
     dataf=pandas.DataFrame(df)
-    dataf.reindex_axis(colorder, axis=1)
-    dataf.to_csv(filename,"\t",index=False,header=False,cols=colorder,engine='python')
+    dataf.to_csv(filename,sep="\t",index=False,header=False,columns=list(colorder))
     return(dataf)
 
 def setupDirectories(dictlist,verbose=True):
@@ -789,17 +1325,20 @@ def merge_lodols(dolList):
         tmp=merge_dols(tmp,dol)
     return(tmp)
 
-def openImage(imName):
-    '''Open an image, strip alpha channel, convert to array of floats.'''
+def openImage(imName,region=None):
+    '''Open an image, strip alpha channel, convert to array of floats.  Optionally crop to region (y0,y1,x0,x1, see cropRegion) before converting.'''
     im=Image.open(imName)
     # Strip alpha channel if present
     im = im.convert("RGB")
+    if region is not None:
+        im=im.crop((region[2],region[0],region[3],region[1]))
     img=im.convert("F")
-    arrN=numpy.array(img,dtype=numpy.float)
+    arrN=numpy.array(img,dtype=numpy.float64)
     return(im,arrN)
 
-def locateCulturesScan(candx,candy,dx,dy,arrN,nx,ny,search=0.4,radFrac=1.0,mkPlots=False,update=True):
-    '''Starting with initial guesses for culture locations (top left corner), optimise individual culture locations and return locations (centre of spots) data frame.'''
+def locateCulturesScan(candx,candy,dx,dy,arrN,nx,ny,search=0.4,radFrac=1.0,mkPlots=False,update=True,plateWide=False):
+    '''Starting with initial guesses for culture locations (top left corner), optimise individual culture locations and return locations (centre of spots) data frame.
+With plateWide, intensity profiles for all cultures are scanned at once (optimiseSpots) rather than one culture at a time (optimiseSpot), with the same results.'''
     # radius is half width of spot tile, rad is "radius" of area tested for brightness (0<radnum<=1.0), RAD is half width of search space
     cols,rows=numpy.meshgrid(numpy.arange(1,nx+1),numpy.arange(1,ny+1))
     d={"Row":rows.flatten(),"Column":cols.flatten(),"y":candy,"x":candx}
@@ -811,11 +1350,21 @@ def locateCulturesScan(candx,candy,dx,dy,arrN,nx,ny,search=0.4,radFrac=1.0,mkPlo
         delta=int(round((radius-rad)/2.0))
         rad=int(round(rad))
         RAD=int(round(search*radius))
-        for i in range(0,len(locations.x)):
-            (x,y)=optimiseSpot(arrN,locations.x[i]+delta,locations.y[i]+delta,rad,RAD,mkPlots)
-            # Note this returns coordinates of CENTRE OF SPOT
-            locations.x[i]=int(round(x-delta+dx/2.0))
-            locations.y[i]=int(round(y-delta+dy/2.0))
+        sat=integralImage(arrN)
+        if plateWide:
+            xs,ys=optimiseSpots(arrN,locations.x.values+delta,locations.y.values+delta,rad,RAD,sat)
+            # Note these are coordinates of CENTRE OF SPOT
+            xs=numpy.round(xs-delta+dx/2.0).astype(int)
+            ys=numpy.round(ys-delta+dy/2.0).astype(int)
+        else:
+            xs,ys=[],[]
+            for i in range(0,len(locations.x)):
+                (x,y)=optimiseSpot(arrN,locations.x[i]+delta,locations.y[i]+delta,rad,RAD,mkPlots,sat)
+                # Note this returns coordinates of CENTRE OF SPOT
+                xs.append(int(round(x-delta+dx/2.0)))
+                ys.append(int(round(y-delta+dy/2.0)))
+        locations["x"]=xs
+        locations["y"]=ys
         print("Cultures located")
     else:
         locations.x=locations.x+dx/2.0
@@ -829,15 +1378,35 @@ def edgeBrightness(arr,pos,dy,dx):
         res=99999999999999999
     return(res)
 
-def locateCultures(candx,candy,dx,dy,arr,nx,ny,update=True,maxupdates=10,fuzzy=0.01):
-    '''Recursively calculate centre of mass for each tile until it converges (or updates maxupdates times).'''
+def tileCentres(arr,py,px,dy,dx):
+    '''Centres of mass of tiles arr[py:py+dy,px:px+dx] (arrays of top left corners, tiles inside the image), relative to top left corners.'''
+    tiles=windowView(arr,dy,dx)[py,px]
+    tot=tiles.sum(axis=(1,2))
+    with numpy.errstate(invalid="ignore",divide="ignore"):
+        comy=tiles.sum(axis=2).dot(numpy.arange(dy,dtype=numpy.float64))/tot
+        comx=tiles.sum(axis=1).dot(numpy.arange(dx,dtype=numpy.float64))/tot
+    return((comy,comx))
+
+def edgeBrightnesses(arr,py,px,dy,dx):
+    '''Vectorised edgeBrightness for arrays of top left corners.  Tiles must lie inside the image (py+dy<h, px+dx<w).'''
+    py,px=py[:,numpy.newaxis],px[:,numpy.newaxis]
+    ys=py+numpy.arange(dy)
+    xs=px+numpy.arange(1,dx-1)
+    res=arr[ys,px].sum(axis=1)+arr[ys,px+dx].sum(axis=1)+arr[py,xs].sum(axis=1)+arr[py+dy,xs].sum(axis=1)
+    return(res)
+
+def locateCultures(candx,candy,dx,dy,arr,nx,ny,update=True,maxupdates=10,fuzzy=0.01,batch=True):
+    '''Recursively calculate centre of mass for each tile until it converges (or updates maxupdates times).
+With batch, each update is carried out for all unconverged tiles at once (see centreTiles).'''
     cols,rows=numpy.meshgrid(numpy.arange(1,nx+1),numpy.arange(1,ny+1))
     cx=list(candx)
     cy=list(candy)
     dx=int(round(dx))
     dy=int(round(dy))
 
-    if update:
+    if update and batch:
+        cy,cx=centreTiles(arr,cy,cx,dy,dx,maxupdates=maxupdates,fuzzy=fuzzy)
+    elif update:
         for i in range(0,len(cx)):
             cy0,cx0=cy[i],cx[i]
             # Get centre of mass
@@ -859,6 +1428,53 @@ def locateCultures(candx,candy,dx,dy,arr,nx,ny,update=True,maxupdates=10,fuzzy=0
     locations["Diameter"]=min(dx,dy)
     return(locations)
 
+def centreTiles(arr,cy,cx,dy,dx,maxupdates=10,fuzzy=0.01):
+    '''Batched centre of mass updates for tiles with top left corners (cy,cx), following the same convergence rules as the per-tile loop in locateCultures.
+Tiles that touch the image edge are handled one at a time with center_of_mass and edgeBrightness.'''
+    h,w=arr.shape
+    py=numpy.array(cy,dtype=int)
+    px=numpy.array(cx,dtype=int)
+
+    def inside(py,px):
+        return((py>=0)&(px>=0)&(py+dy<h)&(px+dx<w))
+
+    def centres(py,px):
+        ok=inside(py,px)
+        comy=numpy.zeros(len(py),dtype=numpy.float64)
+        comx=numpy.zeros(len(px),dtype=numpy.float64)
+        comy[ok],comx[ok]=tileCentres(arr,py[ok],px[ok],dy,dx)
+        for i in numpy.where(~ok)[0]:
+            comy[i],comx[i]=ndimage.measurements.center_of_mass(arr[py[i]:(py[i]+dy),px[i]:(px[i]+dx)])
+        return((comy,comx))
+
+    def edges(py,px):
+        ok=inside(py,px)
+        res=numpy.zeros(len(py),dtype=numpy.float64)
+        res[ok]=edgeBrightnesses(arr,py[ok],px[ok],dy,dx)
+        for i in numpy.where(~ok)[0]:
+            res[i]=edgeBrightness(arr,(py[i],px[i]),dy,dx)
+        return(res)
+
+    # Previous centre of mass starts as (absolute) tile centre, as in the per-tile loop
+    prevy=numpy.round(py+dy/2.0)
+    prevx=numpy.round(px+dx/2.0)
+    edgesum0=edges(py,px)
+    comy,comx=centres(py,px)
+    edgesum=edges(numpy.round(py+comy-dy/2.0).astype(int),numpy.round(px+comx-dx/2.0).astype(int))
+    counter=numpy.zeros(len(py),dtype=int)
+    active=numpy.arange(len(py))
+    while True:
+        keep=((comy[active]!=prevy[active])|(comx[active]!=prevx[active]))&(edgesum[active]<=(1.0+fuzzy)*edgesum0[active])&(counter[active]<maxupdates)
+        active=active[keep]
+        if len(active)==0: break
+        py[active]=numpy.round(py[active]+comy[active]-dy/2.0).astype(int)
+        px[active]=numpy.round(px[active]+comx[active]-dx/2.0).astype(int)
+        prevy[active],prevx[active]=comy[active],comx[active]
+        comy[active],comx[active]=centres(py[active],px[active])
+        edgesum[active]=edges(py[active],px[active])
+        counter[active]+=1
+    return((list(py),list(px)))
+
 def makeMask(arrN,thresh1,tol=5):
     '''Generate an agar mask and a pseudo-empty image from a plate with obvious cultures.  Cultures are identified by thresholding, cut out and filled using a Markov field update.'''
     # Tolerance for average pixel intensity difference between iterations to declare convergence of Markov update
@@ -868,7 +1484,60 @@ def makeMask(arrN,thresh1,tol=5):
     cutout_arr=maskAndFill(arrN,finalMask,tol)
     return (finalMask,cutout_arr)
 
-def maskAndFill(arrN,finalMask,tol=5):
+def maskAndFill(arrN,finalMask,tol=5,backend="auto"):
+    '''Cut out masked pixels from image and re-fill them so that each filled pixel is the mean of its four neighbours, using the inpainting backend chosen by fillBackend.'''
+    name,fill=fillBackend(backend)
+    print("Filling in gaps ("+name+" backend)")
+    return(fill(arrN,finalMask,tol))
+
+def fillBackend(backend="auto"):
+    '''Name and function for an inpainting backend in fillBackends.  "auto" chooses the compiled kernel (maskAndFillCython) if it was built, otherwise NumPy conjugate gradients (maskAndFillCG).'''
+    if backend=="auto":
+        backend="cython" if "cython" in fillBackends else "cg"
+    if backend not in fillBackends:
+        raise ValueError("Unknown inpainting backend "+str(backend)+" (available: "+", ".join(sorted(fillBackends))+")")
+    return((backend,fillBackends[backend]))
+
+def maskAndFillCython(arrN,finalMask,tol=5,omega=1.9):
+    '''Cut out masked pixels from image and re-fill using the compiled Markov field update (colonyzer2/maskfill.pyx), over-relaxed by omega once all masked pixels are filled.'''
+    return(_maskfill.maskAndFill(arrN,finalMask,tol,omega))
+
+def maskAndFillCG(arrN,finalMask,tol=5,maxiter=None):
+    '''Cut out masked pixels from image and re-fill them with the solution of Laplace's equation (each filled pixel is the mean of its four neighbours), the fixed point of the Markov field update in maskAndFillMarkov.
+The sparse linear system for masked pixels is solved by conjugate gradients, iterating until the mean change a Markov field update would make is below tol.  If that takes more than maxiter iterations (default ten times the number of masked pixels), the gaps are filled by maskAndFillRedBlack instead.'''
+    # Unmask edges so that every masked pixel has four neighbours
+    finalMask[0,:]=False
+    finalMask[-1,:]=False
+    finalMask[:,0]=False
+    finalMask[:,-1]=False
+    cutout_arr=numpy.array(arrN,dtype=numpy.float64)
+    (y_list,x_list)=numpy.where(finalMask)
+    n=len(y_list)
+    if n==0:
+        return(cutout_arr)
+    index=numpy.full(arrN.shape,-1,dtype=numpy.int64)
+    index[y_list,x_list]=numpy.arange(n)
+    # 4*x[k]-(masked neighbours of k)=(sum of unmasked neighbour values of k)
+    rhs=numpy.zeros(n,dtype=numpy.float64)
+    rows,cols=[],[]
+    for (ny,nx) in [(y_list+1,x_list),(y_list-1,x_list),(y_list,x_list+1),(y_list,x_list-1)]:
+        nb=index[ny,nx]
+        known=nb<0
+        rhs[known]+=cutout_arr[ny[known],nx[known]]
+        rows.append(numpy.where(~known)[0])
+        cols.append(nb[~known])
+    rows,cols=numpy.concatenate(rows),numpy.concatenate(cols)
+    A=scipy.sparse.identity(n,format="csr")*4.0-scipy.sparse.csr_matrix((numpy.ones(len(rows)),(rows,cols)),shape=(n,n))
+    # Markov field update changes a pixel by (residual/4): bound mean absolute residual by 4*tol
+    x0=numpy.full(n,numpy.mean(cutout_arr[~finalMask]))
+    sol,info=scipy.sparse.linalg.cg(A,rhs,x0=x0,atol=4.0*tol*numpy.sqrt(n),maxiter=10*n if maxiter is None else maxiter)
+    if info!=0:
+        print("Conjugate gradients did not converge, filling in gaps with red-black Markov field updates instead")
+        return(maskAndFillRedBlack(arrN,finalMask,tol))
+    cutout_arr[y_list,x_list]=sol
+    return(cutout_arr)
+
+def maskAndFillMarkov(arrN,finalMask,tol=5):
     '''Cut out masked pixels from image and re-fill using a Markov field update.'''
     # Unmask edges to allow Markov field update
     finalMask[0,:]=False
@@ -880,7 +1549,6 @@ def maskAndFill(arrN,finalMask,tol=5):
     old=numpy.zeros(cutout_arr.shape,dtype=float)
     
     (y_list,x_list)=numpy.where(finalMask)
-    print("Filling in gaps")
     diff=100*tol
     while diff>tol or numpy.isnan(diff):
         # Invert filling order at every pass to minimise bias towards a particular direction
@@ -890,32 +1558,279 @@ def maskAndFill(arrN,finalMask,tol=5):
         # Markov field update
         for i in range(0,len(x_list)):
             plist=[cutout_arr[y_list[i],x_list[i]+1],cutout_arr[y_list[i]+1,x_list[i]],cutout_arr[y_list[i],x_list[i]-1],cutout_arr[y_list[i]-1,x_list[i]]]
-            cutout_arr[y_list[i],x_list[i]]=stats.nanmean(plist)
+            cutout_arr[y_list[i],x_list[i]]=numpy.nanmean(plist)
         diff=numpy.sum(numpy.abs(old-cutout_arr))/numpy.sum(finalMask)
         diff=numpy.sum(numpy.abs(old*finalMask-cutout_arr*finalMask))/numpy.sum(finalMask)
     return(cutout_arr)
-    
-def makeCorrectionMap(arr0,locations,smoothfactor=250,verbose=True):
-    '''Smooth a (pseudo-)empty plate image to generate a correction map.'''
+
+def maskAndFillRedBlack(arrN,finalMask,tol=5,omega=1.9):
+    '''Cut out masked pixels from image and re-fill using a red-black (checkerboard) Markov field update, in NumPy.
+Each half sweep replaces all masked pixels of one colour with the mean of their filled neighbours (from shifted arrays and a count of valid neighbours), using the same convergence criterion as maskAndFillMarkov.  Once all masked pixels are filled, updates are over-relaxed by omega (omega=1 for plain Markov field updates).'''
+    # Unmask edges to allow Markov field update
+    finalMask[0,:]=False
+    finalMask[-1,:]=False
+    finalMask[:,0]=False
+    finalMask[:,-1]=False
+    cutout_arr=numpy.array(arrN,dtype=numpy.float64)
+    (y_list,x_list)=numpy.where(finalMask)
+    nmask=len(y_list)
+    if nmask==0:
+        return(cutout_arr)
+    # Only work on the bounding box of masked pixels (plus a border of known neighbours)
+    y0,y1,x0,x1=numpy.min(y_list)-1,numpy.max(y_list)+2,numpy.min(x_list)-1,numpy.max(x_list)+2
+    box=cutout_arr[y0:y1,x0:x1]
+    mask=finalMask[y0:y1,x0:x1]
+    box[mask]=numpy.nan
+    yy,xx=numpy.mgrid[y0+1:y1-1,x0+1:x1-1]
+    inner=mask[1:-1,1:-1]
+    colours=[inner&((yy+xx)%2==0),inner&((yy+xx)%2==1)]
+    centre=box[1:-1,1:-1]
+    known=numpy.isfinite(box)
+    diff=100*tol
+    while diff>tol or numpy.isnan(diff):
+        old=centre[inner]
+        complete=not numpy.isnan(old).any()
+        for colour in colours:
+            if complete:
+                new=(box[:-2,1:-1]+box[2:,1:-1]+box[1:-1,:-2]+box[1:-1,2:])/4.0
+                new=centre+omega*(new-centre)
+            else:
+                vals=numpy.where(known,box,0.0)
+                count=known[:-2,1:-1].astype(numpy.float64)+known[2:,1:-1]+known[1:-1,:-2]+known[1:-1,2:]
+                with numpy.errstate(invalid="ignore",divide="ignore"):
+                    new=(vals[:-2,1:-1]+vals[2:,1:-1]+vals[1:-1,:-2]+vals[1:-1,2:])/count
+            numpy.copyto(centre,new,where=colour)
+            if not complete:
+                known=numpy.isfinite(box)
+        diff=numpy.sum(numpy.abs(old-centre[inner]))/nmask
+    return(cutout_arr)
+
+fillBackends={"cg":maskAndFillCG,"markov":maskAndFillMarkov,"redblack":maskAndFillRedBlack}
+if _maskfill is not None:
+    fillBackends["cython"]=maskAndFillCython
+
+def cubicWeights(n,f,m,offset=0):
+    '''Sparse matrix interpolating pixels offset...offset+n-1 from m downsampled pixels (pixel i centred on i*f+(f-1)/2.0, as from downsample) with the Keys cubic convolution kernel (a=-0.5), replicating edge values.'''
+    pos=(offset+numpy.arange(n)-(f-1)/2.0)/f
+    base=numpy.floor(pos).astype(int)
+    t=pos-base
+    a=-0.5
+    weights=[a*(t+1)**3-5*a*(t+1)**2+8*a*(t+1)-4*a,(a+2)*t**3-(a+3)*t**2+1,(a+2)*(1-t)**3-(a+3)*(1-t)**2+1,a*(2-t)**3-5*a*(2-t)**2+8*a*(2-t)-4*a]
+    rows=numpy.tile(numpy.arange(n),4)
+    cols=numpy.clip(numpy.concatenate([base-1,base,base+1,base+2]),0,m-1)
+    return(scipy.sparse.csr_matrix((numpy.concatenate(weights),(rows,cols)),shape=(n,m)))
+
+def upsampleCubic(small,shape,f,offset=(0,0)):
+    '''Separable cubic interpolation of an array downsampled by factor f (see downsample) back up to shape, starting from pixel offset.'''
+    wy=cubicWeights(shape[0],f,small.shape[0],offset[0])
+    wx=cubicWeights(shape[1],f,small.shape[1],offset[1])
+    return(wx.dot(wy.dot(small).T).T)
+
+def smoothPyramid(arr,sigma,minsigma=4.0):
+    '''Approximate ndimage.gaussian_filter(arr,sigma) for large sigma: block-mean downsample, smooth with a correspondingly smaller sigma and cubic-interpolate back to full resolution.
+Downsampling factor is chosen so that the downsampled Gaussian still has at least minsigma pixels standard deviation.  On the sample plates (sigma around 15) minsigma=4 keeps relative errors below 0.15%, minsigma=2.5 below 1.5% (see Auxiliary/benchmarkSmoothing.py).'''
+    f=int(max(1,math.floor(sigma/minsigma)))
+    if f==1:
+        return(ndimage.gaussian_filter(numpy.asarray(arr,dtype=numpy.float64),sigma))
+    # Reflect edges at full resolution (as gaussian_filter does), in whole blocks
+    pad=f*int(math.ceil(4.0*sigma/f))
+    small=downsample(numpy.pad(arr,pad,mode="symmetric"),f)
+    # Block means already smooth with variance (f**2-1)/12 (full resolution pixels)
+    sigsmall=math.sqrt(max(0.0,sigma**2-(f**2-1)/12.0))/f
+    return(upsampleCubic(ndimage.gaussian_filter(small,sigsmall,mode="nearest"),arr.shape,f,(pad,pad)))
+
+def openingBackground(arr,size,sigma=0,f=None):
+    '''Estimate agar (background) intensity by grey-scale morphological opening ("rolling ball" with a square ball of side size pixels), removing any bright culture narrower than size.
+Runs on a block-mean downsampled copy (factor f, by default about size/16): separable minimum then maximum filters, optional Gaussian smoothing (sigma full resolution pixels) and cubic interpolation back to full resolution.'''
+    if f is None:
+        f=int(max(1,math.floor(size/16.0)))
+    # Reflect edges at full resolution, in whole blocks
+    pad=f*int(math.ceil((size+4.0*sigma)/f))
+    small=downsample(numpy.pad(arr,pad,mode="symmetric"),f)
+    side=max(1,int(round(float(size)/f)))
+    for axis in (0,1):
+        small=ndimage.minimum_filter1d(small,side,axis=axis,mode="nearest")
+    for axis in (0,1):
+        small=ndimage.maximum_filter1d(small,side,axis=axis,mode="nearest")
+    if sigma>0:
+        small=ndimage.gaussian_filter(small,float(sigma)/f,mode="nearest")
+    return(upsampleCubic(small,arr.shape,f,(pad,pad)))
+
+def gapSamples(arr,locations,nsamp=4000,patchFrac=0.15,seed=0):
+    '''Sample pixels (y,x,intensity) from agar between cultures: square patches (side about patchFrac culture diameters) centred where four neighbouring cultures meet, randomly subsampled to at most nsamp pixels.'''
+    X=locations.pivot(index="Row",columns="Column",values="x").values
+    Y=locations.pivot(index="Row",columns="Column",values="y").values
+    if X.shape[0]<2 or X.shape[1]<2:
+        raise ValueError("Need at least two rows and two columns of cultures to sample gaps between them")
+    gx=(X[:-1,:-1]+X[1:,:-1]+X[:-1,1:]+X[1:,1:]).ravel()/4.0
+    gy=(Y[:-1,:-1]+Y[1:,:-1]+Y[:-1,1:]+Y[1:,1:]).ravel()/4.0
+    h=max(1,int(round(patchFrac*locations.Diameter.iloc[0]/2.0)))
+    # Top left corners of patches, kept inside image
+    py=numpy.clip(numpy.round(gy).astype(int)-h,0,arr.shape[0]-(2*h+1))
+    px=numpy.clip(numpy.round(gx).astype(int)-h,0,arr.shape[1]-(2*h+1))
+    offy,offx=numpy.mgrid[0:2*h+1,0:2*h+1]
+    ys=(py[:,numpy.newaxis]+offy.ravel()).ravel()
+    xs=(px[:,numpy.newaxis]+offx.ravel()).ravel()
+    if len(ys)>nsamp:
+        keep=numpy.random.RandomState(seed).choice(len(ys),nsamp,replace=False)
+        ys,xs=ys[keep],xs[keep]
+    return((ys,xs,arr[ys,xs]))
+
+def fitLightingSurface(arr,locations,degree=4,nsamp=4000,trim=3.0):
+    '''Least squares fit of a 2D Legendre polynomial surface (tensor product, given degree in y and x) to agar intensities sampled between cultures (see gapSamples).
+Samples with residuals more than trim robust standard deviations from the first fit are dropped and the surface refitted.  Returns coefficient array, which evalLightingSurface maps back onto an image of the same shape.'''
+    ys,xs,vals=gapSamples(arr,locations,nsamp=nsamp)
+    h,w=arr.shape
+    V=numpy.polynomial.legendre.legvander2d(2.0*ys/(h-1)-1.0,2.0*xs/(w-1)-1.0,[degree,degree])
+    coef=numpy.linalg.lstsq(V,vals,rcond=None)[0]
+    resid=vals-V.dot(coef)
+    mad=numpy.median(numpy.abs(resid-numpy.median(resid)))
+    keep=numpy.abs(resid)<=trim*1.4826*mad
+    if mad>0 and numpy.sum(keep)>V.shape[1]:
+        coef=numpy.linalg.lstsq(V[keep],vals[keep],rcond=None)[0]
+    return(coef.reshape(degree+1,degree+1))
+
+def evalLightingSurface(coef,shape):
+    '''Evaluate fitted Legendre polynomial surface (see fitLightingSurface) over an image with dimensions shape (separably, without building a coordinate grid).'''
+    vy=numpy.polynomial.legendre.legvander(numpy.linspace(-1.0,1.0,shape[0]),coef.shape[0]-1)
+    vx=numpy.polynomial.legendre.legvander(numpy.linspace(-1.0,1.0,shape[1]),coef.shape[1]-1)
+    return(vy.dot(coef).dot(vx.T))
+
+def makeCorrectionMap(arr0,locations,smoothfactor=250,verbose=True,method="pyramid",degree=4,openfactor=1.2):
+    '''Smooth a (pseudo-)empty plate image to generate a correction map.
+method="pyramid" smooths a downsampled copy of the image (see smoothPyramid), method="exact" smooths at full resolution.
+method="surface" instead fits a polynomial surface (of given degree) to agar pixels sampled between cultures (see fitLightingSurface), method="opening" estimates agar intensity by morphological opening with a window openfactor culture diameters wide (see openingBackground).  Neither needs arr0 to be empty.'''
     dy,dx=locations.Diameter[0],locations.Diameter[0]
-    smoothed_arr=ndimage.gaussian_filter(arr0,arr0.shape[1]/smoothfactor)
-    average_back=numpy.median(smoothed_arr[numpy.min(locations.y):numpy.max(locations.y),numpy.min(locations.x):numpy.max(locations.x)])
+    if method=="surface":
+        smoothed_arr=evalLightingSurface(fitLightingSurface(arr0,locations,degree=degree),arr0.shape)
+    elif method=="opening":
+        smoothed_arr=openingBackground(arr0,openfactor*dx,sigma=arr0.shape[1]/smoothfactor)
+    elif method=="exact":
+        smoothed_arr=ndimage.gaussian_filter(arr0,arr0.shape[1]/smoothfactor)
+    else:
+        smoothed_arr=smoothPyramid(arr0,arr0.shape[1]/smoothfactor)
+    average_back=numpy.median(smoothed_arr[int(numpy.min(locations.y)):int(numpy.max(locations.y)),int(numpy.min(locations.x)):int(numpy.max(locations.x))])
     correction_map=average_back/smoothed_arr
     if verbose: print("Lighting correction map constructed.")
     return(correction_map,average_back)
 
-def measureSizeAndColour(locations,arr,im,finalmask,average_back,barcode,filename):
-    '''Generate culture size and colour estimates given pixel array, culture locations and an image mask.'''
-    edge=getEdges(arr,0.925)
-    locations=sizeSpots(locations,arr,finalmask,edge,average_back)
-    locations=getColours(im,locations,finalmask)
+def imagerID(fname):
+    '''Identify the camera that captured an image from its EXIF tags (make, model and body serial number).  Returns None if there is no serial number, since make and model alone are shared by different imaging rigs.'''
+    try:
+        exif=Image.open(fname).getexif()
+        tags=[exif.get(0x010f),exif.get(0x0110),exif.get_ifd(0x8769).get(0xa431)]
+    except Exception:
+        tags=[None]
+    if tags[-1] is None or str(tags[-1]).strip()=="":
+        return(None)
+    tags=[str(x).strip() for x in tags if x is not None and str(x).strip()!=""]
+    return("_".join("".join(c if c.isalnum() else "-" for c in tag) for tag in tags))
+
+def correctionMapKey(imager,shape,method,imageDate,barcode):
+    '''Filename stem for stored lighting correction maps: imager (see imagerID), image dimensions, method used to build the map (see makeCorrectionMap), calibration date (datetime, see getDate) and barcode of the plate it was built from.'''
+    return("{0}_{1}x{2}_{3}_{4}_{5}".format(imager,shape[0],shape[1],method,imageDate.strftime("%Y-%m-%d"),barcode))
+
+def saveCorrectionMap(mapdir,imager,imageDate,correction_map,method="smooth",barcode=""):
+    '''Store lighting correction map (compressed, single precision) in directory mapdir, together with the imager, method, calibration date and barcode it was built from.  Returns path to .npz file.'''
+    if not os.path.exists(mapdir):
+        os.makedirs(mapdir)
+    fname=os.path.join(mapdir,correctionMapKey(imager,correction_map.shape,method,imageDate,barcode)+".npz")
+    numpy.savez_compressed(fname,correction_map=numpy.asarray(correction_map,dtype=numpy.float32),imager=imager,method=method,date=imageDate.strftime("%Y-%m-%d"),barcode=barcode)
+    return(fname)
+
+def storedCorrectionMap(mapdir,imager,shape,imageDate,method="smooth",blend=1,maxdays=30,verbose=False):
+    '''Lighting correction map from maps stored in mapdir (see saveCorrectionMap) for the same imager, image dimensions and method.
+Averages the blend maps calibrated closest in time to imageDate (whichever plates they were built from), ignoring maps more than maxdays away.  Returns None if there are no suitable maps, or if imager is None (unidentified imagers never share maps).'''
+    if mapdir is None or imager is None or not os.path.isdir(mapdir):
+        return(None)
+    # Keys start with imager, dimensions and method (see correctionMapKey)
+    stem="{0}_{1}x{2}_{3}_".format(imager,shape[0],shape[1],method)
+    candidates=[]
+    for fname in os.listdir(mapdir):
+        if not (fname.startswith(stem) and fname.endswith(".npz")):
+            continue
+        with numpy.load(os.path.join(mapdir,fname)) as dat:
+            if "date" not in dat or str(dat["imager"])!=imager or str(dat["method"])!=method:
+                continue
+            mapDate=datetime.strptime(str(dat["date"]),"%Y-%m-%d")
+        days=abs((mapDate-imageDate).total_seconds())/86400.0
+        if days<=maxdays:
+            candidates.append((days,fname))
+    if len(candidates)==0:
+        return(None)
+    candidates=sorted(candidates)[0:max(1,blend)]
+    maps=[]
+    for days,fname in candidates:
+        with numpy.load(os.path.join(mapdir,fname)) as dat:
+            maps.append(numpy.array(dat["correction_map"],dtype=numpy.float64))
+    if verbose: print("Using stored lighting correction map(s): "+", ".join(fname for days,fname in candidates))
+    return(numpy.mean(maps,axis=0))
+
+def gridBounds(locations,dy,dx,shape):
+    '''Bounds (y0,y1,x0,x1) of the area of an image (dimensions shape) covered by the culture grid, including half a culture width beyond the outermost culture centres.'''
+    y0=max(0,int(round(min(locations.y)-dy/2.0)))
+    y1=min(shape[0],int(round(max(locations.y)+dy/2.0)))
+    x0=max(0,int(round(min(locations.x)-dx/2.0)))
+    x1=min(shape[1],int(round(max(locations.x)+dx/2.0)))
+    return((y0,y1,x0,x1))
+
+def cropRegion(locations,dy,dx,shape,margin=0.25):
+    '''Region (y0,y1,x0,x1) of an image (dimensions shape) worth processing: area covered by the culture grid (see gridBounds) plus a margin (fraction of culture spacing) on every side, leaving out plate walls and bench.'''
+    y0,y1,x0,x1=gridBounds(locations,dy,dx,shape)
+    my,mx=int(math.ceil(margin*dy)),int(math.ceil(margin*dx))
+    return((max(0,y0-my),min(shape[0],y1+my),max(0,x0-mx),min(shape[1],x1+mx)))
+
+def shiftLocations(locations,y,x):
+    '''Copy of locations with culture centres moved by y and x pixels.  Shifting by (-y0,-x0) gives locations within a crop starting at (y0,x0) (see cropRegion), shifting by (y0,x0) maps them back.'''
+    shifted=locations.copy()
+    shifted["y"]=shifted["y"]+y
+    shifted["x"]=shifted["x"]+x
+    return(shifted)
+
+def agarIndices(mask,bounds):
+    '''Flat indices (into arrays with the same shape as mask) of agar pixels: those inside bounds (see gridBounds) which are False in culture mask.'''
+    y0,y1,x0,x1=bounds
+    ys,xs=numpy.nonzero(numpy.logical_not(mask[y0:y1,x0:x1]))
+    return(numpy.ravel_multi_index((ys+y0,xs+x0),mask.shape))
+
+def agarOffset(arr,agar,average_back):
+    '''Additive shift bringing mean intensity of agar pixels in arr (flat indices, see agarIndices) to average_back.'''
+    return(average_back-numpy.mean(numpy.take(arr,agar)))
+
+def agarQuantiles(arr,agar,nq=101):
+    '''Evenly spaced quantiles (nq, including minimum and maximum) of agar pixel intensities in arr (flat indices, see agarIndices).'''
+    return(numpy.percentile(numpy.take(arr,agar),numpy.linspace(0,100,nq)))
+
+def matchAgarHistogram(arr,agar,refq):
+    '''Map intensities in arr (in place) so that agar pixels (flat indices, see agarIndices) have the same distribution as a reference image with agar quantiles refq (see agarQuantiles).
+Mapping interpolates between quantiles and shifts intensities outside the agar range (e.g. cultures) by the same amount as the nearest extreme quantile.'''
+    srcq=agarQuantiles(arr,agar,len(refq))
+    # Merge tied quantiles so that mapping is a function
+    srcq,first=numpy.unique(srcq,return_index=True)
+    dstq=numpy.asarray(refq,dtype=numpy.float64)[first]
+    below,above=arr<srcq[0],arr>srcq[-1]
+    lo,hi=arr[below]+(dstq[0]-srcq[0]),arr[above]+(dstq[-1]-srcq[-1])
+    arr[...]=numpy.interp(arr,srcq,dstq)
+    arr[below]=lo
+    arr[above]=hi
+    return(arr)
+
+def measureSizeAndColour(locations,arr,im,finalmask,average_back,barcode,filename,labels=None):
+    '''Generate culture size and colour estimates (every registered phenotype, see measurePhenotypes) given pixel array, culture locations and an image mask.
+Tiles around cultures (labels, see spotLabels) can be computed once and passed in for every image in a timecourse.  Sobel edges are found in arr (see getEdges), so for an image cropped to the culture grid they are thresholded at a quantile of gradients within the crop.'''
+    locations=measurePhenotypes(locations,arr,finalmask,im=im,background=average_back,labels=labels)
     locations["Barcode"]=barcode
     locations["Filename"]=os.path.basename(filename).split(".")[0]
     return(locations)
 
-def threshPreview(arr,thresh1,locations):
-    '''Generate a preview version of thresholded image with culture locations highlighted (coloured squares).  Suitable for checking that culture location algorithms are functioning.'''
+def threshPreview(arr,thresh1,locations,region=None,shape=None):
+    '''Generate a preview version of thresholded image with culture locations highlighted (coloured squares).  Suitable for checking that culture location algorithms are functioning.
+If arr is cropped (region y0,y1,x0,x1, see cropRegion) from an image with dimensions shape, preview is full size (black outside region) and locations are in full image coordinates.'''
     imthresh=thresholdArr(numpy.copy(arr),thresh1).convert("RGB")
+    if region is not None:
+        full=Image.new("RGB",(shape[1],shape[0]))
+        full.paste(imthresh,(region[2],region[0]))
+        imthresh=full
     draw=ImageDraw.Draw(imthresh)
     colours=((255,0,0),(0,255,0),(0,0,255),(255,255,0),(0,255,255),(255,0,255))
     for i in range(0,len(locations.x)):
@@ -923,20 +1838,31 @@ def threshPreview(arr,thresh1,locations):
         draw.rectangle((x-r,y-r,x+r,y+r),outline=colours[i%5])
     return(imthresh)
 
-def automaticThreshold(arr,label="",pdf=None):
-    '''Choose a threshold for segmenting pixel intensities by fitting two-component Gaussian mixture model'''
+def automaticThreshold(arr,label="",pdf=None,method="lbfgs"):
+    '''Choose a threshold for segmenting pixel intensities by fitting two-component Gaussian mixture model
+Model is fitted by constrained optimisation of the likelihood with finite-difference gradients (method="lbfgs"), the same optimisation with analytic gradients (method="gradient", see makeObjectiveGrad) or by expectation-maximisation on the intensity histogram (method="em", see fitMixtureEM).
+The analytic gradient fit is much faster, but it does not stall where the finite-difference fit does, on images with few cultured pixels.  There it can reach a higher likelihood and give a lower threshold (by up to 8 on early images in Auxiliary/Data/timecourses).'''
     # Initial guess for mixed model parameters for thresholding lighting corrected image
     (counts,intensities)=numpy.histogram(arr,bins=2**8,range=(0,2**8))
-    intensities=numpy.array(intensities[0:-1],dtype=numpy.int)
+    intensities=numpy.array(intensities[0:-1],dtype=int)
     smoothcounts=ndimage.gaussian_filter1d(counts,1)
-    (bindat,[theta,mu1,mu2,sigma1,sigma2])=initialGuess(intensities,smoothcounts)
+    (bindat,[theta,mu1,mu2,sigma1,sigma2])=initialGuessArrays(intensities,smoothcounts)
     if(pdf!=None):
         plotGuess(bindat,label,pdf)
 
     # Maximise likelihood of 2-component mixed Gaussian model parameters given binned observations by constrained optimisation
-    logL=makeObjective(bindat.intensities,bindat.counts,totFunc)
-    b=[(0.0,1.0),(float(mu1)/5.0,5*float(mu1)),(float(mu2)/5.0,5.0*float(mu2)),(float(sigma1)/5.0,5.0*float(sigma1)),(float(sigma2)/5.0,5.0*float(sigma2))]
-    opt=optimize.fmin_l_bfgs_b(logL,[theta,mu1,mu2,sigma1,sigma2],bounds=b,approx_grad=True)
+    if method=="em":
+        opt=[fitMixtureEM(bindat["intensities"],bindat["counts"],[theta,mu1,mu2,sigma1,sigma2])]
+    else:
+        b=[(0.0,1.0),(float(mu1)/5.0,5*float(mu1)),(float(mu2)/5.0,5.0*float(mu2)),(float(sigma1)/5.0,5.0*float(sigma1)),(float(sigma2)/5.0,5.0*float(sigma2))]
+        if method=="gradient":
+            # Gradient is infinite where either component has zero weight
+            b[0]=(1e-9,1.0-1e-9)
+            logL=makeObjectiveGrad(bindat["intensities"],bindat["counts"])
+            opt=optimize.fmin_l_bfgs_b(logL,[theta,mu1,mu2,sigma1,sigma2],bounds=b)
+        else:
+            logL=makeObjective(bindat["intensities"],bindat["counts"],totFunc)
+            opt=optimize.fmin_l_bfgs_b(logL,[theta,mu1,mu2,sigma1,sigma2],bounds=b,approx_grad=True)
     [theta_opt,mu1_opt,mu2_opt,sigma1_opt,sigma2_opt]=opt[0]
 
     thresh=getRoot(opt[0],intensities)
@@ -948,10 +1874,11 @@ def automaticThreshold(arr,label="",pdf=None):
         thresh1-=1
 
     # Modelled densities
-    bindat["mixed"]=numpy.array([totFunc(x,opt[0]) for x in bindat.intensities],dtype=numpy.float)
-    bindat["gauss1"]=numpy.array([theta_opt*stats.norm.pdf(x,mu1_opt,sigma1_opt) for x in bindat.intensities],dtype=numpy.float)
-    bindat["gauss2"]=numpy.array([(1.0-theta_opt)*stats.norm.pdf(x,mu2_opt,sigma2_opt) for x in bindat.intensities],dtype=numpy.float)
-    return((thresh1,bindat))
+    bindat["mixed"]=totFunc(bindat["intensities"],opt[0])
+    bindat["gauss1"]=theta_opt*stats.norm.pdf(bindat["intensities"],mu1_opt,sigma1_opt)
+    bindat["gauss2"]=(1.0-theta_opt)*stats.norm.pdf(bindat["intensities"],mu2_opt,sigma2_opt)
+    # Binned data and model are returned as a data frame, as before arrays were used internally
+    return((thresh1,pandas.DataFrame(bindat)))
 
 def openQFA(fname):
     '''Reads tab-delimited QFA data, processes it and returns dataframe'''
@@ -31,6 +31,7 @@ def parseArgs(inp=''):
 
     parser.add_argument("-c","--lc", help="Enable lighting correction?", action="store_true")
     parser.add_argument("-m","--diffims", help="If lighting correction switched on, attempt to correct for lighting differences between images in timecourse (can induce slight negative cell density estimates).", action="store_true")
+    parser.add_argument("-t","--histmatch", help="When correcting for lighting differences between images (see -m), match agar intensity distribution of each image to that of last image, instead of shifting mean agar intensity.", action="store_true")
     parser.add_argument("-p","--plots", help="Plot pixel intensity distributions, segmentation thresholds and spot location traces?", action="store_true")
     parser.add_argument("-i","--initpos", help="Use intial guess for culture positions from Colonyzer.txt file?", action="store_true")
     parser.add_argument("-x","--cut", help="Cut culture signal from first image to make pseudo-empty plate?", action="store_true")
@@ -41,6 +42,11 @@ def parseArgs(inp=''):
     parser.add_argument("-f","--fixthresh", type=float, help="Image segmentation threshold value (default is automatic thresholding).")
     parser.add_argument("-u","--usedict", type=str, help="Load .json file specifying images to analyse.  If argument has a .json extension, treat as filename.  Otherwise assume argument is a HTS-style screen ID and return path to appropriate .json file from directory structure.  See C2Find.py in HTSauto package.")
     parser.add_argument("-o","--fmt", type=str, nargs='+', help="Specify rectangular grid format, either using integer shorthand (e.g. -o 96, -o 384, -o 768 -o 1536) or explicitly specify number of rows followed by number of columns (e.g.: -o 24 16 or -o 24x16)", default=['384'])
+    parser.add_argument("-g","--gridcache", type=str, help="JSON file caching culture grid solutions by image dimensions, plate format and capture date.  Cached solutions are checked and reused for new images, falling back to a full search when checks fail.")
+    parser.add_argument("-k","--mapdir", type=str, help="Directory for storing lighting correction maps (keyed by imager, image dimensions, method (see -b), date of earliest image and barcode), for reuse with -r.")
+    parser.add_argument("-n","--imager", type=str, help="Identifier for the imaging rig, used to store and reuse lighting correction maps (see -k and -r).  By default, the camera's make, model and serial number are read from the images.  Maps are neither stored nor reused for images without a serial number unless this is given.")
+    parser.add_argument("-b","--background", type=str, choices=["smooth","surface","opening"], help="If lighting correction switched on, how to estimate agar intensity for the correction map: smooth first (or pseudo-empty, see -x) image, fit polynomial surface to agar between cultures in first image, or morphological opening of last image (for plates where no image is empty).", default="smooth")
+    parser.add_argument("-r","--reusemaps", type=int, help="If lighting correction switched on, use maps stored in directory given by -k (same imager, image dimensions and method, from within 30 days) instead of building a new map.  Averages up to this many maps, closest in time first.  A new map is built and stored if none are found.", default=0)
     #parser.add_argument("-","--fmt", type=str, nargs='+', help="Specify rectangular grid format, either using integer shorthand (e.g. -o 96, -o 384, -o 768 -o 1536) or explicitly specify number of rows followed by number of columns (e.g.: -o 24 16 or -o 24x16)", default=['384'])
     
 
@@ -94,6 +100,7 @@ def buildVars(inp=''):
         if inp.lc:
             if inp.diffims:
                 print("Correcting for lighting differences between subsequent images of same plate.")
+                if inp.histmatch: print("Matching agar intensity distributions between images.")
                 diffIms=True
             else:
                 print("Any lighting differences between plates will be ignored.")
@@ -106,7 +113,11 @@ def buildVars(inp=''):
         else:
             print("Searching for colony locations automatically.")
         cut=False
-        if inp.lc:
+        if inp.lc and inp.background=="opening":
+            print("Estimating agar intensity by morphological opening of last image (for lighting correction).")
+        elif inp.lc and inp.background=="surface":
+            print("Fitting polynomial surface to agar between cultures in first image (for lighting correction).")
+        elif inp.lc:
             if inp.cut:
                 print("Cutting cell signal from first image to create pseudo-empty plate (for lighting correction).")
                 cut=True
@@ -118,7 +129,7 @@ def buildVars(inp=''):
             print("Images will be segmented using fixed threshold: "+str(fixedThresh)+".")
         if fdict is not None and os.path.exists(fdict):
             print("Preparing to load barcodes from "+fdict+".")
-    res={'lc':inp.lc,'fixedThresh':fixedThresh,'plots':inp.plots,'initpos':inp.initpos,'fdict':fdict,'fdir':fdir,'nrow':nrow,'ncol':ncol,'cut':cut,'verbose':verbose,'diffims':diffIms}
+    res={'lc':inp.lc,'fixedThresh':fixedThresh,'plots':inp.plots,'initpos':inp.initpos,'fdict':fdict,'fdir':fdir,'nrow':nrow,'ncol':ncol,'cut':cut,'verbose':verbose,'diffims':diffIms,'gridcache':inp.gridcache,'mapdir':inp.mapdir,'reusemaps':inp.reusemaps,'background':inp.background,'histmatch':inp.histmatch,'imager':inp.imager}
     return(res)
 
 def locateJSON(scrID,dirHTS='.',verbose=False):
@@ -156,31 +167,12 @@ def loadLocationGuesses(IMAGE,InsData):
         (candx,candy,dx,dy)=c2.SetUp(InsData['default'])
     return((candx,candy,dx,dy))
 
-def cutEdgesFromMask(mask,locations):
-    '''Mask for identifying culture areas (edge detection). Set all pixels outside culture grid to background, to aid binary filling later.'''
-    mask[0:min(locations.y-dy/2),:]=False
-    mask[max(locations.y+dy/2):mask.shape[0],:]=False
-    mask[:,0:min(locations.x-dx/2)]=False
-    mask[:,max(locations.x+dx/2):mask.shape[1]]=False
-    return(mask)
-
-def edgeFill(arr,locations,cutoff=0.8):
-    edgeN=getEdges(arr,cutoff=0.8)
-    dilN=ndimage.morphology.binary_dilation(edgeN,iterations=2)
-    erodeN=ndimage.morphology.binary_erosion(dilN,iterations=1)
-    dil2N=ndimage.morphology.binary_dilation(dilN,iterations=3)
-    
-    fillN=ndimage.morphology.binary_fill_holes(cutEdgesFromMask(dil2N,locations))
-    maskN=ndimage.morphology.binary_erosion(fillN,iterations=7)
-    return(maskN)
-
 def main(inp=""):
     print("Colonyzer "+c2.__version__)
 
-    cythonFill=False
-
     var=buildVars(inp=inp)
-    correction,fixedThresh,plots,initpos,fdict,fdir,nrow,ncol,cut,verbose,diffIms=(var["lc"],var["fixedThresh"],var["plots"],var["initpos"],var["fdict"],var["fdir"],var["nrow"],var["ncol"],var["cut"],var["verbose"],var["diffims"])
+    correction,fixedThresh,plots,initpos,fdict,fdir,nrow,ncol,cut,verbose,diffIms,gridcache=(var["lc"],var["fixedThresh"],var["plots"],var["initpos"],var["fdict"],var["fdir"],var["nrow"],var["ncol"],var["cut"],var["verbose"],var["diffims"],var["gridcache"])
+    mapdir,reusemaps,background,histmatch,imagerName=var["mapdir"],var["reusemaps"],var["background"],var["histmatch"],var["imager"]
     barcdict=checkImages(fdir,fdict,verbose=verbose)
     rept=c2.setupDirectories(barcdict,verbose=verbose)
 
@@ -212,34 +204,73 @@ def main(inp=""):
             corner=[0,0]; com=[0,0]; guess=[0,0]
         else:
             # Automatically generate guesses for gridded array locations
-            (candx,candy,dx,dy,corner,com,guess)=c2.estimateLocations(arrN,ncol,nrow,showPlt=plots,pdf=pdf,glob=False,verbose=verbose)
+            located=None
+            if gridcache is not None:
+                # Try cached grid solution for this imager, plate format and week before searching
+                cache=c2.readGridCache(gridcache)
+                key=c2.gridCacheKey(arrN.shape,nrow,ncol,c2.getDate(LATESTIMAGE))
+                if key in cache:
+                    located=c2.warmStartLocations(arrN,ncol,nrow,cache[key],verbose=verbose)
+                    if verbose and located is None: print("Cached grid solution rejected, searching for culture locations")
+            if located is None:
+                located=c2.estimateLocations(arrN,ncol,nrow,showPlt=plots,pdf=pdf,glob=False,verbose=verbose,returnSoln=True)
+                if gridcache is not None:
+                    cache=c2.readGridCache(gridcache)
+                    cache[key]=c2.cacheEntry(arrN,nrow,ncol,located)
+                    c2.writeGridCache(gridcache,cache)
+            (candx,candy,dx,dy,corner,com,guess,soln)=located
 
         # Update guesses and initialise locations data frame
         locationsN=c2.locateCultures([int(round(cx-dx/2.0)) for cx in candx],[int(round(cy-dy/2.0)) for cy in candy],dx,dy,arrN,ncol,nrow,update=True)
 
+        # Every image is processed within the culture grid (plus margin), with culture locations relative to that region
+        region=c2.cropRegion(locationsN,dy,dx,arrN.shape)
+        crop=(slice(region[0],region[1]),slice(region[2],region[3]))
+        locationsC=c2.shiftLocations(locationsN,-region[0],-region[2])
+
         if correction:
-            if cut:
-                mask=edgeFill(arr0,locationsN,0.8)
-                startFill=time.time()
-                if cythonFill:
-                    pseudoempty=maskAndFillCython(arr0,maskN,0.005)
-                    print("Inpainting using Cython & NumPy: "+str(time.time()-startFill)+" s")
-                else:
-                    pseudoempty=maskAndFill(arr0,mask,0.005)
-                    print("Inpainting using NumPy: "+str(time.time()-start)+" s")
+            imager=imagerName if imagerName is not None else c2.imagerID(EARLIESTIMAGE)
+            calDate=c2.getDate(EARLIESTIMAGE)
+            mapMethod=background+"-cut" if (background=="smooth" and cut) else background
+            if imager is None and mapdir is not None:
+                print("Imager not identified (no camera serial number, see -n): lighting correction maps will not be stored or reused")
+            stored=None
+            if reusemaps>0:
+                stored=c2.storedCorrectionMap(mapdir,imager,arr0.shape,calDate,method=mapMethod,blend=reusemaps,verbose=verbose)
+            if stored is not None:
+                correction_map=stored
+                # Background intensity of this plate after correction
+                average_back=numpy.median((arr0*correction_map)[int(numpy.min(locationsN.y)):int(numpy.max(locationsN.y)),int(numpy.min(locationsN.x)):int(numpy.max(locationsN.x))])
             else:
-                pseudoempty=arr0
-                # Smooth (pseudo-)empty image 
-                (correction_map,average_back)=c2.makeCorrectionMap(pseudoempty,locationsN,verbose=verbose)
-                
-                # Correct spatial gradient in final image
-                corrected_arrN=arrN*correction_map
+                if background=="opening":
+                    # Open away cultures from last image in one pass (earliest image need not be empty)
+                    (correction_map,average_back)=c2.makeCorrectionMap(arrN,locationsN,verbose=verbose,method="opening")
+                elif background=="surface":
+                    (correction_map,average_back)=c2.makeCorrectionMap(arr0,locationsN,verbose=verbose,method="surface")
+                else:
+                    if cut:
+                        mask=c2.cultureMask(arr0,locationsN,0.8)
+                        startFill=time.time()
+                        backend,fill=c2.fillBackend()
+                        pseudoempty=fill(arr0,mask,0.005)
+                        if verbose: print("Inpainting using "+backend+" backend: "+str(time.time()-startFill)+" s")
+                    else:
+                        pseudoempty=arr0
+                    # Smooth (pseudo-)empty image 
+                    (correction_map,average_back)=c2.makeCorrectionMap(pseudoempty,locationsN,verbose=verbose)
+                if mapdir is not None and imager is not None:
+                    c2.saveCorrectionMap(mapdir,imager,calDate,correction_map,method=mapMethod,barcode=BARCODE)
+            
+            # Correct spatial gradient in final image (maps are stored full size, but only needed within region here)
+            correction_map=correction_map[crop]
+            corrected_arrN=arrN[crop]*correction_map
         else:
             average_back=numpy.mean(arr0[numpy.min(locationsN.y):numpy.max(locationsN.y),numpy.min(locationsN.x):numpy.max(locationsN.x)])
-            corrected_arrN=arrN
+            corrected_arrN=arrN[crop]
 
         # Trim outer part of image to remove plate walls
-        trimmed_arrN=corrected_arrN[max(0,int(round(min(locationsN.y)-dy/2.0))):min(arrN.shape[0],int(round((max(locationsN.y)+dy/2.0)))),max(0,int(round(min(locationsN.x)-dx/2.0))):min(arrN.shape[1],int(round((max(locationsN.x)+dx/2.0))))]
+        bounds=c2.gridBounds(locationsC,dy,dx,corrected_arrN.shape)
+        trimmed_arrN=corrected_arrN[bounds[0]:bounds[1],bounds[2]:bounds[3]]
         
         if fixedThresh>=0:
             thresh=fixedThresh
@@ -249,40 +280,52 @@ def main(inp=""):
                 c2.plotModel(bindat,label=BARCODE,pdf=pdf)
 
         # Mask for identifying culture areas
-        maskN=numpy.ones(arrN.shape,dtype=numpy.bool)
-        maskN[corrected_arrN<thresh]=False
+        maskN=corrected_arrN>=thresh
+
+        if diffIms:
+            # Agar pixels in last image, for normalising brightness of every image in timecourse
+            agar=c2.agarIndices(maskN,bounds)
+            if histmatch:
+                # Reference agar intensity distribution, shifted to average background intensity
+                refshift=c2.agarOffset(corrected_arrN,agar,average_back)
+                refq=c2.agarQuantiles(corrected_arrN,agar)+refshift
+
+        # Tiles around cultures, shared by every image in timecourse
+        labels=c2.spotLabels(locationsC,corrected_arrN.shape)
 
         for FILENAME in barcdict[BARCODE]:
 
             startim=time.time()
             
-            im,arr=c2.openImage(FILENAME)
+            # Only region is converted, corrected and measured.  Sobel edges (Perimeter, Circularity) are thresholded at a quantile of gradients within region rather than over the whole image.
+            im,arr=c2.openImage(FILENAME,region=region)
             if correction:
-                arr=arr*correction_map
+                arr*=correction_map
 
-            if diffIms:
+            if diffIms and histmatch:
+                # Correct for lighting differences between plates, matching agar intensity distributions
+                c2.matchAgarHistogram(arr,agar,refq)
+                threshadj=thresh+refshift
+            elif diffIms:
                 # Correct for lighting differences between plates
-                arrsm=arr[max(0,int(round(min(locationsN.y)-dy/2.0))):min(arrN.shape[0],int(round((max(locationsN.y)+dy/2.0)))),max(0,int(round(min(locationsN.x)-dx/2.0))):min(arrN.shape[1],int(round((max(locationsN.x)+dx/2.0))))]
-                masksm=maskN[max(0,int(round(min(locationsN.y)-dy/2.0))):min(arrN.shape[0],int(round((max(locationsN.y)+dy/2.0)))),max(0,int(round(min(locationsN.x)-dx/2.0))):min(arrN.shape[1],int(round((max(locationsN.x)+dx/2.0))))]
-                meanPx=numpy.mean(arrsm[numpy.logical_not(masksm)])
-
-                arr=arr+(average_back-meanPx)
-                threshadj=thresh+(average_back-meanPx)
+                offset=c2.agarOffset(arr,agar,average_back)
+                arr+=offset
+                threshadj=thresh+offset
             else:
                 threshadj=thresh
 
-            mask=numpy.ones(arr.shape,dtype=numpy.bool)
-            mask[corrected_arrN<threshadj]=False
+            mask=corrected_arrN>=threshadj
 
-            # Measure culture phenotypes
-            locations=c2.measureSizeAndColour(locationsN,arr,im,mask,average_back,BARCODE,FILENAME[0:-4])
+            # Measure culture phenotypes, then map locations back onto full image
+            locations=c2.measureSizeAndColour(locationsC,arr,im,mask,average_back,BARCODE,FILENAME[0:-4],labels=labels)
+            locations=c2.shiftLocations(locations,region[0],region[2])
 
             # Write results to file
-            locations.to_csv(os.path.join(os.path.dirname(FILENAME),"Output_Data",os.path.basename(FILENAME).split(".")[0]+".out"),"\t",index=False,engine='python')
+            locations.to_csv(os.path.join(os.path.dirname(FILENAME),"Output_Data",os.path.basename(FILENAME).split(".")[0]+".out"),sep="\t",index=False)
             dataf=c2.saveColonyzer(os.path.join(os.path.dirname(FILENAME),"Output_Data",os.path.basename(FILENAME).split(".")[0]+".dat"),locations,threshadj,dx,dy)
 
             # Visual check of culture locations
-            imthresh=c2.threshPreview(arr,threshadj,locations)
+            imthresh=c2.threshPreview(arr,threshadj,locations,region=region,shape=arrN.shape)
             r=5
             draw=ImageDraw.Draw(imthresh)
             draw.ellipse((com[1]-r,com[0]-r,com[1]+r,com[0]+r),fill=(255,0,0))
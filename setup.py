@@ -1,4 +1,4 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 import numpy
 import os
 import subprocess
@@ -37,13 +37,14 @@ f.close()
 # Nice tutorial on packaging python code:
 # http://www.scotttorborg.com/python-packaging/
 
+# Compiled inpainting kernel is optional: colonyzer2 falls back to NumPy if it cannot be built
 try:
-    from Cython.Distutils import build_ext
+    from Cython.Build import cythonize
 except ImportError:
-    ext_modules=[]
+    # Build from C source generated from maskfill.pyx (regenerate with: cython -3 colonyzer2/maskfill.pyx)
+    ext_modules=[Extension("colonyzer2.maskfill",["colonyzer2/maskfill.c"],optional=True)]
 else:
-    from Cython.Build import cythonize
-    ext_modules=cythonize("./colonyzer2/maskfill.pyx")
+    ext_modules=cythonize([Extension("colonyzer2.maskfill",["colonyzer2/maskfill.pyx"],optional=True)])
 
 setup(name='Colonyzer2',
       version=version,
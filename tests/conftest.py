@@ -0,0 +1,17 @@
+import os,glob,numpy,pytest
+from PIL import Image
+
+DATA=os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,"Auxiliary","Data")
+
+def loadImage(fname):
+    '''Same image and array of floats as colonyzer2.openImage'''
+    im=Image.open(fname).convert("RGB")
+    return(im,numpy.array(im.convert("F"),dtype=numpy.float64))
+
+@pytest.fixture(scope="session")
+def endpoint():
+    return(loadImage(sorted(glob.glob(os.path.join(DATA,"endpoints","384","*.jpg")))[0]))
+
+@pytest.fixture(scope="session")
+def timecourse():
+    return(sorted(glob.glob(os.path.join(DATA,"timecourses","*.jpg"))))
@@ -0,0 +1,21 @@
+import numpy
+from datetime import datetime
+import colonyzer2 as c2
+
+def test_sample_images_have_no_imager_id(timecourse):
+    # Make and model alone would be shared by every rig with the same camera
+    assert c2.imagerID(timecourse[0]) is None
+
+def test_maps_kept_per_barcode_and_method(tmp_path):
+    mapdir=str(tmp_path)
+    day=datetime(2009,7,1)
+    for barcode,value in (("PLATE1",1.0),("PLATE2",3.0)):
+        c2.saveCorrectionMap(mapdir,"rig1",day,numpy.full((4,5),value),method="smooth",barcode=barcode)
+    c2.saveCorrectionMap(mapdir,"rig1",day,numpy.full((4,5),10.0),method="opening",barcode="PLATE1")
+    c2.saveCorrectionMap(mapdir,"rig2",day,numpy.full((4,5),20.0),method="smooth",barcode="PLATE3")
+    # Both smooth maps from the same day are stored and blended, without maps from other methods or rigs
+    blended=c2.storedCorrectionMap(mapdir,"rig1",(4,5),day,method="smooth",blend=5)
+    assert numpy.allclose(blended,2.0)
+    assert numpy.allclose(c2.storedCorrectionMap(mapdir,"rig1",(4,5),day,method="opening",blend=5),10.0)
+    assert c2.storedCorrectionMap(mapdir,"rig1",(6,5),day,method="smooth") is None
+    assert c2.storedCorrectionMap(mapdir,None,(4,5),day,method="smooth") is None
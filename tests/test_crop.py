@@ -0,0 +1,25 @@
+import os,shutil,pandas,pytest
+import colonyzer2 as c2
+from scripts import parseAndRun
+from conftest import DATA
+
+images=["DLR00012647-2009-06-30_14-38-44.jpg","DLR00012647-2009-07-04_09-35-20.jpg"]
+
+def analyse(root,options):
+    os.makedirs(root)
+    for im in images:
+        shutil.copy(os.path.join(DATA,"timecourses",im),root)
+    parseAndRun.main(options+" -d "+root)
+    return([pandas.read_csv(os.path.join(root,"Output_Data",im.split(".")[0]+".out"),sep="\t") for im in images])
+
+@pytest.mark.parametrize("options",["-c -m","-c -m -t"])
+def test_crop_matches_whole_image(tmp_path,monkeypatch,options):
+    cropped=analyse(str(tmp_path/"cropped"),options)
+    # Region covering the whole image: nothing cropped
+    monkeypatch.setattr(c2,"cropRegion",lambda locations,dy,dx,shape,margin=0.25:(0,shape[0],0,shape[1]))
+    whole=analyse(str(tmp_path/"whole"),options)
+    # Edges are thresholded at a quantile of gradients within the crop, so only edge-based phenotypes differ
+    edgecols=["Perimeter","Circularity"]
+    for c,w in zip(cropped,whole):
+        pandas.testing.assert_frame_equal(c.drop(columns=edgecols),w.drop(columns=edgecols))
+        assert (c.Perimeter>0).mean()>0.9
@@ -0,0 +1,45 @@
+import numpy
+import colonyzer2 as c2
+from scipy import ndimage, stats
+from conftest import loadImage
+
+def hypotEdges(arr,cutoff):
+    '''Edge map as thresholded before getEdges used partitioned order statistics'''
+    sob=numpy.hypot(ndimage.sobel(arr,axis=0),ndimage.sobel(arr,axis=1))
+    thresh=stats.mstats.mquantiles(sob,cutoff)[0]
+    return((sob>=thresh)&(sob>0),sob,thresh)
+
+def test_edges_match_on_sample_image(timecourse):
+    arr=loadImage(timecourse[-1])[1]
+    ref,sob,thresh=hypotEdges(arr,0.9975)
+    assert numpy.array_equal(c2.getEdges(arr),ref)
+
+def test_edges_differ_only_at_ties_with_cutoff():
+    ndiff=0
+    for seed in range(0,10):
+        arr=numpy.random.RandomState(seed).randint(0,16,(60,70)).astype(numpy.float64)
+        for cutoff in numpy.linspace(0.4,0.95,12):
+            ref,sob,thresh=hypotEdges(arr,cutoff)
+            diff=c2.getEdges(arr,cutoff)!=ref
+            ndiff+=numpy.sum(diff)
+            assert numpy.allclose(sob[diff],thresh,rtol=1e-12,atol=0)
+    # Quantized input: some tied pixels do change sides
+    assert ndiff>0
+
+def test_sampled_cutoff_close_to_full_quantile(timecourse):
+    arr=loadImage(timecourse[-1])[1]
+    full=c2.getEdges(arr,0.8)
+    sampled=c2.getEdges(arr,0.8,sample=8)
+    assert abs(numpy.mean(sampled)-numpy.mean(full))<0.005
+
+def test_culture_mask_confined_to_grid_crop(timecourse):
+    arr=loadImage(timecourse[-1])[1]
+    candy,candx=c2.grid([279.43,329.58,136.66,0.1365],16,24)
+    locations=c2.locateCultures([int(round(x-68.5)) for x in candx],[int(round(y-68.5)) for y in candy],137,137,arr,24,16,update=False)
+    mask=c2.cultureMask(arr,locations,0.8)
+    y0,y1,x0,x1=c2.gridBounds(locations,137,137,arr.shape)
+    inside=numpy.zeros(arr.shape,dtype=bool)
+    inside[max(0,y0-6):y1+6,max(0,x0-6):x1+6]=True
+    assert not numpy.any(mask[~inside])
+    # Grown cultures on the last image cover a large share of the grid
+    assert mask[inside].mean()>0.2
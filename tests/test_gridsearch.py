@@ -0,0 +1,23 @@
+import numpy
+import colonyzer2 as c2
+
+def candidates(arr,ny,nx,n,seed=0):
+    rng=numpy.random.RandomState(seed)
+    d=min(arr.shape[0]/float(ny+1),arr.shape[1]/float(nx+1))
+    y0=rng.uniform(0,arr.shape[0]-ny*d,n)
+    x0=rng.uniform(0,arr.shape[1]-nx*d,n)
+    return(numpy.column_stack([y0,x0,numpy.full(n,d),rng.uniform(-5,5,n)]))
+
+def test_checkPosBatch_matches_checkPos(endpoint):
+    arr=endpoint[1][::4,::4]
+    params=candidates(arr,16,24,20)
+    for stat in ("median","mean"):
+        batch=c2.checkPosBatch(arr,16,24,params,sampfrac=0.35,stat=stat)
+        loop=[c2.checkPos(arr,16,24,p[0:2],p[2],p[2],p[3],sampfrac=0.35,stat=stat) for p in params]
+        assert numpy.allclose(batch,loop)
+
+def test_coarse_mean_locates_same_grid_as_median(endpoint):
+    arr=endpoint[1][::4,::4].copy()
+    mean=c2.estimateLocations(arr,24,16,showPlt=False,returnSoln=True,coarseStat="mean")[-1]
+    median=c2.estimateLocations(arr,24,16,showPlt=False,returnSoln=True,coarseStat="median")[-1]
+    assert numpy.allclose(mean,median)
@@ -0,0 +1,25 @@
+import numpy
+import colonyzer2 as c2
+
+def test_plateWide_scan_matches_optimiseSpot(endpoint):
+    arr=endpoint[1]
+    # Grid located by estimateLocations on this image
+    candy,candx=c2.grid([279.43,329.58,136.66,0.1365],16,24)
+    d=137
+    cx=[int(round(x-d/2.0)) for x in candx]
+    cy=[int(round(y-d/2.0)) for y in candy]
+    for radFrac in (1.0,0.6):
+        scan=c2.locateCulturesScan(cx,cy,d,d,arr,24,16,radFrac=radFrac)
+        wide=c2.locateCulturesScan(cx,cy,d,d,arr,24,16,radFrac=radFrac,plateWide=True)
+        assert numpy.array_equal(scan.x.values,wide.x.values)
+        assert numpy.array_equal(scan.y.values,wide.y.values)
+
+def test_optimiseSpots_clipped_at_image_edge():
+    rng=numpy.random.RandomState(0)
+    arr=rng.uniform(0,255,(80,90))
+    x=numpy.array([0,3,40,85,70])
+    y=numpy.array([2,78,40,0,60])
+    sat=c2.integralImage(arr)
+    xs,ys=c2.optimiseSpots(arr,x,y,4,10,sat)
+    for i in range(len(x)):
+        assert (xs[i],ys[i])==c2.optimiseSpot(arr,x[i],y[i],4,10,sat=sat)
@@ -0,0 +1,24 @@
+import numpy,pytest
+import colonyzer2 as c2
+
+@pytest.mark.parametrize("backend",sorted(c2.fillBackends))
+def test_backend_fills_plane(backend):
+    # A plane is harmonic, so filling a hole in it should give the plane back
+    yy,xx=numpy.mgrid[0:24,0:32]
+    arr=10.0+2.0*yy+3.0*xx
+    mask=numpy.zeros(arr.shape,dtype=bool)
+    mask[6:18,8:20]=True
+    name,fill=c2.fillBackend(backend)
+    filled=fill(arr,mask.copy(),0.001)
+    assert name==backend
+    assert not numpy.isnan(filled).any()
+    assert numpy.allclose(filled,arr,atol=0.5)
+
+def test_cg_falls_back_without_convergence(capsys):
+    yy,xx=numpy.mgrid[0:24,0:32]
+    arr=10.0+2.0*yy+3.0*xx
+    mask=numpy.zeros(arr.shape,dtype=bool)
+    mask[6:18,8:20]=True
+    filled=c2.maskAndFillCG(arr,mask,0.001,maxiter=1)
+    assert "did not converge" in capsys.readouterr().out
+    assert numpy.allclose(filled,arr,atol=0.5)
@@ -0,0 +1,39 @@
+import os,warnings,numpy,pandas
+import colonyzer2 as c2
+from conftest import loadImage
+
+# Thresholds from the finite-difference fit before the likelihood was vectorised (greyscale images, no lighting correction)
+baseline={"DLR00012647-2009-06-30_14-38-44.jpg":147,"DLR00012647-2009-07-01_08-47-30.jpg":141,"DLR00012647-2009-07-01_17-01-59.jpg":149,
+          "DLR00012647-2009-07-02_23-12-49.jpg":128,"DLR00012647-2009-07-03_15-42-49.jpg":137,"DLR00012647-2009-07-04_09-35-20.jpg":137,
+          "DLR00012709-2009-06-30_14-36-26.jpg":145,"DLR00012709-2009-07-01_08-47-57.jpg":145,"DLR00012709-2009-07-01_16-56-20.jpg":143,
+          "DLR00012709-2009-07-02_08-58-15.jpg":140,"DLR00012709-2009-07-02_23-07-28.jpg":126,"DLR00012709-2009-07-03_15-37-55.jpg":130,
+          "DLR00012709-2009-07-04_09-30-05.jpg":138}
+
+def test_default_fit_reproduces_baseline(timecourse):
+    for fname in timecourse:
+        if os.path.basename(fname) in baseline:
+            thresh,bindat=c2.automaticThreshold(loadImage(fname)[1])
+            assert thresh==baseline[os.path.basename(fname)]
+
+def test_gradient_fit_within_documented_difference(timecourse):
+    for fname in timecourse:
+        if os.path.basename(fname) in baseline:
+            arr=loadImage(fname)[1]
+            thresh,bindat=c2.automaticThreshold(arr,method="gradient")
+            assert abs(thresh-baseline[os.path.basename(fname)])<=8
+
+def test_gradient_finite_at_theta_bounds():
+    ints=numpy.arange(256.0)
+    cnts=numpy.round(1e5*(0.7*numpy.exp(-0.5*((ints-100)/8.0)**2)+0.3*numpy.exp(-0.5*((ints-170)/15.0)**2))).astype(int)
+    logL=c2.makeObjectiveGrad(ints,cnts)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        for theta in (1e-9,0.6,1.0-1e-9):
+            val,grad=logL([theta,98.0,172.0,9.0,14.0])
+            assert numpy.isfinite(val) and numpy.all(numpy.isfinite(grad))
+
+def test_bindat_is_data_frame(timecourse):
+    thresh,bindat=c2.automaticThreshold(loadImage(timecourse[-1])[1])
+    assert isinstance(bindat,pandas.DataFrame)
+    for col in ("intensities","counts","P1","P2","frac","freq","mixed","gauss1","gauss2"):
+        assert len(getattr(bindat,col))==len(bindat)